@@ -1,35 +1,263 @@
-import json
+"""
+Converts trees of source assets into binary movie files for the server.
 
-from PIL import Image
+    python main.py assets/ --output movies/ --size 64x64 --jobs 8
+    python main.py assets/ --output movies/ --panel ../server/panel.json
+
+Sources, found recursively below every input:
+- animated (or still) GIF, APNG and WebP files, every frame keeps its delay
+- piskel files, played at their fps
+- directories of PNG frames (an input directory too), sorted by name and played at --fps
+
+The output tree mirrors the input tree, every source becomes one .movie file. A manifest in the output directory
+records the content hash and options of every source, unchanged sources are skipped on the next run.
+"""
+import argparse
 import binascii
-import base64
+import hashlib
 import io
+import json
 import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+# Shares the movie model, binary format and animation handling with the server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+import animation
+import movie_format
+from graphics_mock import Movie, dedupe_frames, nominal_fps
+from panel_config import PanelConfig
+
+FRAMESIZE = PanelConfig().content_size
+MANIFEST = '.manifest.json'
+MOVIE_EXTENSION = '.movie'
+
+ANIMATION_EXTENSIONS = ('.gif', '.apng', '.webp')
+PISKEL_EXTENSION = '.piskel'
+FRAME_EXTENSIONS = ('.png',)
+
+
+class Source:
+    """One movie to build, a file or a directory of frames, with its output path relative to the output root."""
+
+    def __init__(self, kind: str, path: str, output: str):
+        self.kind = kind  # 'animation', 'piskel' or 'frames'
+        self.path = path
+        self.output = output
+
+    def files(self) -> list:
+        if self.kind == 'frames':
+            return frame_files(self.path)
+        return [self.path]
+
+    def content_hash(self) -> str:
+        h = hashlib.sha256()
+        for file_name in self.files():
+            h.update(os.path.basename(file_name).encode('utf-8') + b'\0')
+            with open(file_name, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    h.update(chunk)
+        return h.hexdigest()
+
+
+def frame_files(directory: str) -> list:
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.lower().endswith(FRAME_EXTENSIONS) and os.path.isfile(os.path.join(directory, name)))
+
+
+def find_sources(root: str) -> list:
+    """
+    All sources below root, a single file is a source by itself. PNG frames directly in root are a source named
+    after root, like the frames of any directory below it.
+    """
+    if os.path.isfile(root):
+        name = os.path.splitext(os.path.basename(root))[0]
+        kind = 'piskel' if root.lower().endswith(PISKEL_EXTENSION) else 'animation'
+        return [Source(kind, root, name + MOVIE_EXTENSION)]
+
+    sources = list()
+    for directory, directories, files in os.walk(root):
+        directories.sort()
+        relative = os.path.relpath(directory, root)
+        for name in sorted(files):
+            lower = name.lower()
+            output = os.path.normpath(os.path.join(relative, os.path.splitext(name)[0] + MOVIE_EXTENSION))
+            if lower.endswith(ANIMATION_EXTENSIONS):
+                sources.append(Source('animation', os.path.join(directory, name), output))
+            elif lower.endswith(PISKEL_EXTENSION):
+                sources.append(Source('piskel', os.path.join(directory, name), output))
+
+        if frame_files(directory):
+            name = os.path.basename(os.path.abspath(root)) if relative == '.' else os.path.normpath(relative)
+            sources.append(Source('frames', directory, name + MOVIE_EXTENSION))
+    return sources
+
+
+def load_piskel(file_name: str) -> tuple:
+    """(fps, frames) of a piskel file, all layers composited in order."""
+    with open(file_name, 'r') as f:
+        j = json.load(f)
+    if j['modelVersion'] != 2:
+        raise ValueError("Unknown piskel model version " + str(j['modelVersion']))
+
+    piskel = j['piskel']
+    width, height = piskel['width'], piskel['height']
+    frames = None
+    for layer_json in piskel['layers']:
+        layer = json.loads(layer_json)
+        opacity = float(layer.get('opacity', 1))
+        if frames is None:
+            frames = [Image.new('RGBA', (width, height)) for _ in range(int(layer['frameCount']))]
+
+        for chunk in layer['chunks']:
+            png = binascii.a2b_base64(str(chunk['base64PNG']).removeprefix('data:image/png;base64,'))
+            with io.BytesIO(png) as f:
+                sheet = Image.open(f).convert('RGBA')
+            # The layout lists the frame indices of the sprite sheet column by column
+            for column, indices in enumerate(chunk['layout']):
+                for row, index in enumerate(indices):
+                    part = sheet.crop((column * width, row * height, (column + 1) * width, (row + 1) * height))
+                    if opacity < 1:
+                        part.putalpha(part.getchannel('A').point(lambda a: round(a * opacity)))
+                    frames[index] = Image.alpha_composite(frames[index], part)
+
+    return piskel['fps'], frames or list()
+
+
+def load_source(source: Source, size: tuple, fps: int) -> Movie:
+    if source.kind == 'animation':
+        with open(source.path, 'rb') as f:
+            # Already running in a worker process
+            frames, durations = animation.load_animation(f.read(), size, parallel=False)
+        return Movie(nominal_fps(durations), dedupe_frames(frames), durations)
+
+    if source.kind == 'piskel':
+        fps, images = load_piskel(source.path)
+    else:
+        images = list()
+        for file_name in source.files():
+            with Image.open(file_name) as image:
+                images.append(image.convert('RGBA'))
+
+    frames = [animation.fit_to_panel(animation.flatten(image), size) for image in images]
+    return Movie(fps, dedupe_frames(frames))
+
+
+def build(source: Source, output_root: str, options: dict, previous: dict) -> tuple:
+    """
+    Runs in a worker process. Returns (output, manifest entry, status), status is 'skipped', 'built' or the error.
+    """
+    try:
+        entry = {'hash': source.content_hash(), 'options': options}
+        output = os.path.join(output_root, source.output)
+        if previous == entry and os.path.exists(output):
+            return source.output, entry, 'skipped'
+
+        size = tuple(options['size']) if options['size'] is not None else None
+        movie = load_source(source, size, options['fps'])
+        if len(movie.frames) == 0:
+            raise ValueError("No frames")
+
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        movie_format.write_atomic(output, movie.save_to_binary())
+        return source.output, entry, 'built'
+    except (OSError, ValueError) as e:
+        return source.output, None, f"{type(e).__name__}: {e}"
+    except Exception as e:
+        traceback.print_exc()
+        return source.output, None, f"{type(e).__name__}: {e}"
+
+
+def load_manifest(output_root: str) -> dict:
+    try:
+        with open(os.path.join(output_root, MANIFEST), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_manifest(output_root: str, manifest: dict):
+    data = json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8')
+    movie_format.write_atomic(os.path.join(output_root, MANIFEST), data)
+
 
-FRAMESIZE = (64, 64)
+def parse_size(value: str) -> tuple:
+    try:
+        width, height = (int(v) for v in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid size {value}, expected WIDTHxHEIGHT")
+    return width, height
 
 
-def convert_sprite_b64(filename: str):
-    with open(filename, 'rb') as f:
-        return base64.b64encode(f.read()).decode('ascii')  # should be safe, because of base64
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help="Source files or directories")
+    parser.add_argument('--output', '-o', required=True, help="Output directory")
+    parser.add_argument('--size', type=parse_size, default=FRAMESIZE,
+                        help="Panel size the frames are fit into, as WIDTHxHEIGHT (default: 64x64)")
+    parser.add_argument('--panel', help="Panel config of the server, the frames are fit into its size (after "
+                                        "rotation), instead of --size")
+    parser.add_argument('--fps', type=int, default=5, help="Frame rate of frame directories (default: %(default)s)")
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument('--force', action='store_true', help="Rebuild all sources, even unchanged ones")
+    args = parser.parse_args()
+    if args.panel is not None:
+        try:
+            args.size = PanelConfig.load(args.panel).content_size
+        except (OSError, ValueError) as e:
+            parser.error(f"Invalid panel config: {e}")
 
+    options = {'size': list(args.size), 'fps': args.fps, 'format': movie_format.VERSION}
+    os.makedirs(args.output, exist_ok=True)
+    manifest = dict() if args.force else load_manifest(args.output)
 
-def convert_directory(directory: str):
-    sprite_files = os.listdir(directory)
-    sprite_files.sort()
+    sources = list()
+    for root in args.inputs:
+        sources.extend(find_sources(root))
+    if not sources:
+        print(f"No sources found in {', '.join(args.inputs)}", file=sys.stderr)
+        return 1
 
-    payload = dict()
-    payload['fps'] = 5
+    start = time.monotonic()
+    counts = {'built': 0, 'skipped': 0, 'failed': 0}
 
-    sprites_b64 = list()
-    for file in sprite_files:
-        sprites_b64.append(convert_sprite_b64(directory + "/" + file))
+    # Sources with the same output (e.g. foo.gif and foo.webp) would overwrite each other, none of them is built
+    by_output = dict()
+    for source in sources:
+        by_output.setdefault(source.output, list()).append(source)
+    for output, clashing in by_output.items():
+        if len(clashing) > 1:
+            counts['failed'] += len(clashing)
+            manifest.pop(output, None)
+            print(f"Failed {output}: built from {', '.join(source.path for source in clashing)}", file=sys.stderr)
+    sources = [source for source in sources if len(by_output[source.output]) == 1]
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        futures = [executor.submit(build, source, args.output, options, manifest.get(source.output))
+                   for source in sources]
+        for i, future in enumerate(futures):
+            output, entry, status = future.result()
+            if entry is None:
+                counts['failed'] += 1
+                manifest.pop(output, None)
+                print(f"Failed {output}: {status}", file=sys.stderr)
+            else:
+                counts[status] += 1
+                manifest[output] = entry
+                if status == 'built':
+                    print(f"Built {output}")
 
-    payload['frames'] = sprites_b64
+            if (i + 1) % 100 == 0:
+                save_manifest(args.output, manifest)  # an interrupted run keeps its progress
 
-    print(json.dumps(payload))
+    save_manifest(args.output, manifest)
+    print(f"{sum(counts.values())} sources in {time.monotonic() - start:.1f}s: {counts['built']} built, "
+          f"{counts['skipped']} unchanged, {counts['failed']} failed")
+    return 1 if counts['failed'] else 0
 
 
 if __name__ == '__main__':
-    convert_directory(directory="/Users/msei/Downloads/ntt")
-    # convert_directory(directory="/Users/msei/Downloads/frog-ganbatte-merged/")
+    sys.exit(main())
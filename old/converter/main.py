@@ -3,6 +3,7 @@ import io
 import json
 import math
 
+import numpy as np
 from PIL import Image
 
 
@@ -60,37 +61,51 @@ def load_piskel(file_name) -> PixelImage:
 
 
 class MatrixConverter:
-    def find_palette(self, image: PixelImage) -> {(int, int, int)}:
-        dp = dict()
-        for frame in image.frames:
-            pixels = frame.load()
-            for x in range(image.width):
-                for y in range(image.height):
-                    c = pixels[x, y]
-                    if c not in dp:
-                        dp[c] = 1
-        return dp
-
-    def create_numbered_palette(self, colors: {(int, int, int)}) -> ({(int, int, int): int}, [(int, int, int)]):
-        l = list()
-        for key in colors:
-            l.append(key[0:3])
-
-        nd = dict()
-        for i in range(len(l)):
-            nd[l[i]] = i
-
-        return nd, l
-
-    def convert_frame(self, palette: {(int, int, int): int}, frame: Image) -> [int]:
-        pixels = frame.load()
-        ret = list()
-        for x in range(frame.width):
-            for y in range(frame.height):
-                c = pixels[x, y]
-                ret.append(palette[c[0:3]])
-
-        return ret
+    """
+    Converts a PixelImage to the indexed format of the CircuitPython player. Colors are found and mapped to
+    palette indices with NumPy over all frames at once. The format has room for 255 colors, movies with more
+    are quantized to a shared palette first.
+    """
+
+    MAX_COLORS = 255
+
+    def __init__(self, max_colors: int = MAX_COLORS):
+        self.max_colors = max_colors
+
+    @staticmethod
+    def frame_array(frame: Image) -> np.ndarray:
+        return np.asarray(frame if frame.mode == 'RGB' else frame.convert('RGB'))
+
+    @staticmethod
+    def pack(rgb: np.ndarray) -> np.ndarray:
+        """(..., 3) uint8 colors as single 0xRRGGBB integers, so they can be compared and sorted at once."""
+        rgb = rgb.astype(np.uint32)
+        return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+    def find_palette(self, image: PixelImage) -> np.ndarray:
+        """All distinct colors of all frames, packed and sorted."""
+        stacked = np.stack([self.frame_array(frame) for frame in image.frames])
+        return np.unique(self.pack(stacked))
+
+    def create_numbered_palette(self, colors: np.ndarray) -> (np.ndarray, [(int, int, int)]):
+        colors = np.asarray(colors, dtype=np.uint32)
+        rgb = np.stack([(colors >> 16) & 0xFF, (colors >> 8) & 0xFF, colors & 0xFF], axis=-1)
+        return colors, [tuple(int(v) for v in color) for color in rgb]
+
+    def convert_frame(self, palette: np.ndarray, frame: Image) -> np.ndarray:
+        """Palette index of every pixel, column by column like the player reads them."""
+        indices = np.searchsorted(palette, self.pack(self.frame_array(frame)))
+        return indices.T.astype(np.uint8).ravel()
+
+    def quantize(self, image: PixelImage) -> PixelImage:
+        """The image reduced to max_colors colors, with one palette shared by all frames."""
+        # All frames stacked into one tall image, so the palette is chosen for the whole movie
+        stacked = Image.fromarray(np.concatenate([self.frame_array(frame) for frame in image.frames]), 'RGB')
+        quantized = stacked.quantize(colors=self.max_colors, method=Image.Quantize.MEDIANCUT).convert('RGB')
+        rgb = np.asarray(quantized)
+        height = image.frames[0].height
+        frames = [Image.fromarray(rgb[i * height:(i + 1) * height], 'RGB') for i in range(len(image.frames))]
+        return PixelImage(image.height, image.width, image.fps, frames)
 
     @staticmethod
     def to_byte(i: int) -> int:
@@ -104,31 +119,28 @@ class MatrixConverter:
         # 3 - bytes for each colour       5
         # 1... - number in the palette for every frame and pixel
 
-        with io.BytesIO() as f:
-            f.write(self.to_byte(image.width))
-            f.write(self.to_byte(image.height))
-            f.write(self.to_byte(len(image.frames)))
-
+        palette = self.find_palette(image)
+        if len(palette) > self.max_colors:
+            image = self.quantize(image)
             palette = self.find_palette(image)
-            numbered_dict_palette, list_palette = self.create_numbered_palette(palette)
-
-            f.write(self.to_byte(len(list_palette)))
-            f.write(self.to_byte(image.fps))
-
-            for color in list_palette:
-                for p in color:
-                    f.write(self.to_byte(p))
-
-            for frame in image.frames:
-                pi = self.convert_frame(numbered_dict_palette, frame)
-
-                for c in pi:
-                    f.write(self.to_byte(c))
-
-            f.flush()
-            f.seek(0)
-
-            return binascii.b2a_base64(f.getvalue())
+        numbered_palette, list_palette = self.create_numbered_palette(palette)
+
+        # The frames may have been resized since the image was loaded
+        width, height = image.frames[0].size
+        header = [width, height, len(image.frames), len(list_palette), image.fps]
+        if max(header) > 255:
+            raise ValueError(f"Image does not fit into the format (width, height, frames, colors, fps): {header}")
+
+        stacked = np.stack([self.frame_array(frame) for frame in image.frames])
+        # frame, x, y order
+        indices = np.searchsorted(numbered_palette, self.pack(stacked)).transpose(0, 2, 1).astype(np.uint8)
+
+        data = b''.join([
+            bytes(header),
+            np.array(list_palette, dtype=np.uint8).tobytes(),
+            indices.tobytes(),
+        ])
+        return binascii.b2a_base64(data)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,121 @@
+import io
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+# Animated GIF, APNG and WebP images as frames and per-frame durations. PIL resolves disposal and blending while
+# seeking, every frame is composited onto black (a dark LED) and fit into the panel geometry.
+#
+# This module only depends on PIL, so it can be used by the converter and by spawned worker processes.
+
+CONTENT_TYPES = ('image/gif', 'image/png', 'image/apng', 'image/webp')
+
+MIN_DELAY_MS = 20
+DEFAULT_DELAY_MS = 100  # like browsers, frames without (or with a tiny) delay are shown this long
+MAX_DELAY_MS = 0xFFFF
+
+# Frames of an animation depend on the previous ones, a worker has to seek through all frames before its range.
+# That only pays off for long animations, where compositing and resizing dominate.
+PARALLEL_MIN_FRAMES = 64
+
+_POOL = None
+
+
+def open_animation(data: bytes) -> Image:
+    try:
+        return Image.open(io.BytesIO(data))
+    except OSError:
+        raise ValueError("Not a GIF, PNG or WebP image")
+
+
+def frame_delay(frame: Image) -> int:
+    delay = frame.info.get('duration') or 0
+    return min(MAX_DELAY_MS, int(delay)) if delay >= MIN_DELAY_MS else DEFAULT_DELAY_MS
+
+
+def fit_to_panel(image: Image, size: tuple) -> Image:
+    """
+    Scales an RGB image to fit into size (width, height), keeping its aspect ratio, centered on black.
+    Pixel art is enlarged without smoothing, larger images are scaled down with a good filter.
+    """
+    if size is None or image.size == tuple(size):
+        return image
+
+    width, height = size
+    scale = min(width / image.width, height / image.height)
+    scaled_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    resample = Image.NEAREST if scale >= 1 else Image.LANCZOS
+    scaled = image.resize(scaled_size, resample)
+    if scaled.size == (width, height):
+        return scaled
+
+    result = Image.new('RGB', (width, height))
+    result.paste(scaled, ((width - scaled.width) // 2, (height - scaled.height) // 2))
+    return result
+
+
+def flatten(frame: Image) -> Image:
+    """The frame as RGB, transparent pixels become black."""
+    if frame.mode == 'RGB':
+        return frame.copy()
+    rgba = frame.convert('RGBA')
+    background = Image.new('RGBA', rgba.size, (0, 0, 0, 255))
+    return Image.alpha_composite(background, rgba).convert('RGB')
+
+
+def extract_frames(data: bytes, size: tuple = None, start: int = 0, stop: int = None) -> tuple:
+    """Frames [start, stop) as RGB images and their durations in milliseconds."""
+    animation = open_animation(data)
+    stop = getattr(animation, 'n_frames', 1) if stop is None else stop
+
+    frames = list()
+    durations = list()
+    for i in range(start, stop):
+        animation.seek(i)  # applies disposal and blending of the frames before
+        frames.append(fit_to_panel(flatten(animation), size))
+        durations.append(frame_delay(animation))
+    return frames, durations
+
+
+def _extract_range(data: bytes, size: tuple, start: int, stop: int) -> tuple:
+    # Runs in a worker process, raw bytes are much cheaper to send back than pickled images
+    frames, durations = extract_frames(data, size, start, stop)
+    return [(frame.size, frame.tobytes()) for frame in frames], durations
+
+
+def process_pool() -> ProcessPoolExecutor:
+    """
+    Worker processes are spawned rather than forked, the server has threads which must not be copied mid-flight.
+    Created on first use and kept for later uploads.
+    """
+    global _POOL
+    if _POOL is None:
+        _POOL = ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=multiprocessing.get_context('spawn'))
+    return _POOL
+
+
+def load_animation(data: bytes, size: tuple = None, parallel: bool = True) -> tuple:
+    """
+    Frames and durations of an animated (or still) GIF, PNG or WebP. Long animations are split into contiguous
+    frame ranges, which are extracted by worker processes.
+    """
+    frame_count = getattr(open_animation(data), 'n_frames', 1)
+
+    workers = os.cpu_count() or 1
+    if not parallel or workers < 2 or frame_count < PARALLEL_MIN_FRAMES:
+        return extract_frames(data, size)
+
+    chunk = -(-frame_count // workers)
+    ranges = [(start, min(start + chunk, frame_count)) for start in range(0, frame_count, chunk)]
+    pool = process_pool()
+    futures = [pool.submit(_extract_range, data, size, start, stop) for start, stop in ranges]
+
+    frames = list()
+    durations = list()
+    for future in futures:
+        raw_frames, raw_durations = future.result()
+        frames.extend(Image.frombytes('RGB', frame_size, raw) for frame_size, raw in raw_frames)
+        durations.extend(raw_durations)
+    return frames, durations
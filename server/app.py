@@ -1,90 +1,209 @@
 import math
 
 from flask import Flask, request
-from graphics_mock import Movie
-from graphics_rgb import Graphics
+from graphics_mock import MAX_FPS, Movie, MovieTooLarge
+from movie_stream import MovieLimits, load_movie_from_stream, load_movie_from_binary_stream, \
+    load_movie_from_animation_stream, read_encoded_movie_from_stream, read_encoded_movie_from_binary_stream, \
+    read_encoded_animation_from_stream, read_encoded_movie_from_dict, EncodedMovie
+from jobs import Job, JobManager, TooManyJobs
+from concurrent.futures import ThreadPoolExecutor
+import movie_format
+from lazy_movie import LazyCanvasList, map_movie
+from canvas_cache import CanvasCache
+from movie_store import MovieStore
+from playlist import Playlist, PlaylistEntry
+from render_state import MovieSnapshot, RenderState
+from frame_scheduler import FrameScheduler, POLICIES
+from panel_config import PanelConfig
+from compositor import ClockSource, Compositor, MovieSource, Zone
+from frame_stream import FrameStream
+from canvas_pool import CanvasPoolExhausted
 import threading
 import time
 import traceback
-from timeit import default_timer as timer
+import metrics
+import animation
 import os
 
+if os.environ.get('MATRIX_GRAPHICS') == 'mock':
+    from graphics_mock import Graphics  # Runs without a panel, for development and benchmark.py
+else:
+    from graphics_rgb import Graphics
+
 app = Flask(__name__)
 
-BRIGHTNESS: int = 20
-GLOBAL_GRAPHICS = Graphics(BRIGHTNESS)
-CURRENT_MOVIE: Movie = None
-NEXT_MOVIE: Movie = None
+DEFAULT_MOVIE = 'default.movie'
+MOVIE_STORE = MovieStore('movies')
+PANEL_CONFIG_FILE = os.environ.get('MATRIX_PANEL_CONFIG', 'panel.json')
+
+# Without a config file, the defaults describe the original cabinet: two 64x32 panels folded by the U-mapper
+PANEL_CONFIG = PanelConfig.load(PANEL_CONFIG_FILE) if os.path.exists(PANEL_CONFIG_FILE) else PanelConfig()
 
-EXECUTION_TIME_START = 0
-EXECUTION_TIME_COUNT = 0
-ACHIEVED_FPS = -1
+BRIGHTNESS: int = 20
+GLOBAL_GRAPHICS = Graphics(BRIGHTNESS, panel=PANEL_CONFIG)
+RENDER_STATE = RenderState()
+RENDER_WAKEUP = RENDER_STATE.changed  # shared by everything which changes what the panel shows
+FRAME_SCHEDULER = FrameScheduler()
+COMPOSITOR = Compositor(GLOBAL_GRAPHICS, GLOBAL_GRAPHICS.size or PANEL_CONFIG.content_size, wakeup=RENDER_WAKEUP)
+FRAME_STREAM = FrameStream(GLOBAL_GRAPHICS, GLOBAL_GRAPHICS.size or PANEL_CONFIG.content_size,
+                           wakeup=RENDER_WAKEUP)  # see control_server
+CANVAS_CACHE = CanvasCache(max_bytes=64 * 1024 * 1024)
+if GLOBAL_GRAPHICS.pool is not None:
+    GLOBAL_GRAPHICS.pool.reclaimers.append(CANVAS_CACHE.clear)
+    metrics.gauge('matrix_canvas_pool_in_use', 'Canvases of the pool held by movies, caches or the panel',
+                  lambda: GLOBAL_GRAPHICS.pool.stats()['in_use'])
+    metrics.gauge('matrix_canvas_pool_allocated', 'Native canvases created so far (never freed)',
+                  lambda: GLOBAL_GRAPHICS.pool.allocated)
+UPLOAD_LIMITS = MovieLimits(max_frames=2000, max_bytes=64 * 1024 * 1024, max_pixels=256 * 256)
+
+BRIGHTNESS_CHANGED = threading.Event()
+
+# Uploads are converted by jobs, which spread the frame decoding over all cores
+JOBS = JobManager(max_workers=2, max_pending=4)
+DECODE_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix='decode')
+PUBLISH_LOCK = threading.Lock()
+PUBLISHED_JOB_SERIAL = 0
+
+ACHIEVED_FPS = metrics.RateMeter(window=2.0)  # frames displayed per second
+
+FRAME_LATENCY_SECONDS = metrics.histogram('matrix_frame_latency_seconds',
+                                          'Time from the frame deadline until the frame was swapped in',
+                                          metrics.SECONDS_FAST)
+SWAP_SECONDS = metrics.histogram('matrix_swap_seconds', 'Duration of display_canvas (SwapOnVSync)',
+                                 metrics.SECONDS_FAST)
+SLEEP_OVERSHOOT_SECONDS = metrics.histogram('matrix_sleep_overshoot_seconds',
+                                            'How late the render loop woke up after its frame deadline',
+                                            metrics.SECONDS_FAST)
+DROPPED_FRAMES = metrics.counter('matrix_dropped_frames_total', 'Frames skipped because the render loop was late')
+DISPLAYED_FRAMES = metrics.counter('matrix_displayed_frames_total', 'Frames swapped onto the panel')
+DECODE_SECONDS = metrics.histogram('matrix_decode_seconds', 'Time to decode all frames of an uploaded movie',
+                                   metrics.SECONDS_SLOW)
+COMPOSE_SECONDS = metrics.histogram('matrix_compose_seconds', 'Time to composite the zones and convert the frame',
+                                    metrics.SECONDS_FAST)
+UPLOAD_BYTES = metrics.histogram('matrix_upload_bytes', 'Size of uploaded movies', metrics.BYTES)
+metrics.gauge('matrix_achieved_fps', 'Frames displayed per second over the last seconds', ACHIEVED_FPS.rate)
 
 
 def swap_to_default_movie():
-    global NEXT_MOVIE
-    if not os.path.exists('default.movie'):
+    if not os.path.exists(DEFAULT_MOVIE):
         print("No default movie exists.")
         return
 
-    with open('default.movie', 'r') as f:
-        temp = Movie.load_from_json(f.read())
-        temp.canvass = GLOBAL_GRAPHICS.convert_to_canvas(temp.frames)
-        NEXT_MOVIE = temp
+    with open(DEFAULT_MOVIE, 'rb') as f:
+        is_binary = movie_format.is_binary_movie(f.read(len(movie_format.MAGIC)))
+
+    if not is_binary:
+        # Upgrade a JSON movie from an older version once, so it can be mapped from now on
+        with open(DEFAULT_MOVIE, 'r') as f:
+            temp = Movie.load_from_json(f.read())
+        movie_format.write_atomic(DEFAULT_MOVIE, temp.save_to_binary())
+
+    show_mapped_movie(map_movie(DEFAULT_MOVIE, GLOBAL_GRAPHICS))
 
 
-def clear_frame_timing():
-    global EXECUTION_TIME_COUNT, EXECUTION_TIME_START
-    EXECUTION_TIME_START = 0
-    EXECUTION_TIME_COUNT = 0
+def show_mapped_movie(temp: Movie):
+    temp.canvass[0]  # Convert the first frame right away, the rest is converted in the background
+    temp.canvass.start_prefetch()
+    RENDER_STATE.publish(temp)
 
 
 def graphics_main():
-    global CURRENT_MOVIE, NEXT_MOVIE, BRIGHTNESS, EXECUTION_TIME_COUNT, EXECUTION_TIME_START, ACHIEVED_FPS
+    """
+    Event driven: after showing a frame, the loop blocks on RENDER_WAKEUP until the next frame is due or anything
+    changes (a new movie, fps, brightness, clear, zones or a streamed frame). Static content costs no wakeups.
+    """
     frame = 0
     exceptions = 0
+    shown = None  # snapshot of the last iteration
+    displayed = None  # (canvases, frame) on the panel
+    composing = False
+    streaming = False
     try:
         while True:
             try:
-                switched_movie = False
-                if CURRENT_MOVIE is None and NEXT_MOVIE is None:
-                    time.sleep(0.5)
+                # Changes from here on wake up the wait at the end of this iteration
+                RENDER_WAKEUP.clear()
+
+                if FRAME_STREAM.active:
+                    # Live frames take over the panel while they arrive, the newest frame is shown
+                    streaming = True
+                    canvas = FRAME_STREAM.take()
+                    if canvas is not None:
+                        with SWAP_SECONDS.time():
+                            GLOBAL_GRAPHICS.display_canvas(canvas)
+                        FRAME_STREAM.swapped(canvas)
+                        DISPLAYED_FRAMES.inc()
+                        ACHIEVED_FPS.mark()
+                    RENDER_WAKEUP.wait(FRAME_STREAM.timeout())
+                    continue
+                if streaming:
+                    streaming = False
+                    GLOBAL_GRAPHICS.clear()
+                    COMPOSITOR.invalidate()
+                    shown = displayed = None
+
+                if COMPOSITOR.active:
+                    # Zones take over the whole panel until they are removed, the movie is kept
+                    composing = True
+                    canvas = COMPOSITOR.tick()
+                    if canvas is not None:
+                        with SWAP_SECONDS.time():
+                            GLOBAL_GRAPHICS.display_canvas(canvas)
+                        COMPOSE_SECONDS.observe(COMPOSITOR.last_compose_seconds)
+                        DISPLAYED_FRAMES.inc()
+                        ACHIEVED_FPS.mark()
+                    RENDER_WAKEUP.wait(COMPOSITOR.timeout())
+                    continue
+                if composing:
+                    composing = False
+                    GLOBAL_GRAPHICS.clear()
+                    shown = displayed = None  # show the movie again from its start
+
+                # Everything in this iteration is read from one immutable snapshot
+                snapshot = RENDER_STATE.take()
+                if snapshot is None or len(snapshot.canvass) == 0:
+                    if shown is not None:
+                        GLOBAL_GRAPHICS.clear()
+                        shown = displayed = None
+                    RENDER_WAKEUP.wait()
                     continue
-                elif CURRENT_MOVIE is None or NEXT_MOVIE is not None:
-                    switched_movie = True
-                    CURRENT_MOVIE = NEXT_MOVIE
-                    NEXT_MOVIE = None
 
+                switched_movie = shown is None or snapshot.serial != shown.serial
                 if switched_movie:
-                    print(f"Displaying new Movie {len(CURRENT_MOVIE.canvass)} frames at {CURRENT_MOVIE.fps} fps")
+                    if shown is not None and isinstance(shown.canvass, LazyCanvasList):
+                        shown.canvass.cancel_prefetch()
+                    print(f"Displaying new Movie {len(snapshot.canvass)} frames at {snapshot.fps} fps")
                     frame = 0
-                    clear_frame_timing()
-                    ACHIEVED_FPS = -1
-                    EXECUTION_TIME_START = timer()
-
-                if len(CURRENT_MOVIE.canvass) > 1 or switched_movie:
-                    # Do not refresh on static images
-                    GLOBAL_GRAPHICS.display_canvas(CURRENT_MOVIE.canvass[frame])
-
-                if len(CURRENT_MOVIE.canvass) > 1:
-                    frame = (frame + 1) % (len(CURRENT_MOVIE.canvass) - 1)
-                    wait_time = max(1.0 / 60.0, 1.0 / float(CURRENT_MOVIE.fps) - 0.005)  # limit to 60fps
+                    ACHIEVED_FPS.reset()
+                    FRAME_SCHEDULER.start()
+                shown = snapshot
+
+                canvass = snapshot.canvass
+                if switched_movie or displayed != (canvass, frame):
+                    # Static images (and paused movies) are only displayed again after re-conversion
+                    with SWAP_SECONDS.time():
+                        GLOBAL_GRAPHICS.display_canvas(canvass[frame])
+                    FRAME_LATENCY_SECONDS.observe(max(0.0, time.monotonic() - FRAME_SCHEDULER.last_deadline))
+                    DISPLAYED_FRAMES.inc()
+                    ACHIEVED_FPS.mark()
+                    displayed = (canvass, frame)
+
+                if len(canvass) > 1 and snapshot.durations is not None:
+                    # Sleeps until the next absolute frame deadline, may skip frames when we fell behind.
+                    # A change wakes it up early without advancing (step 0).
+                    step = FRAME_SCHEDULER.wait(snapshot.durations, frame, RENDER_WAKEUP)
+                    if step > 1:
+                        DROPPED_FRAMES.inc(step - 1)
+                    if FRAME_SCHEDULER.last_overshoot is not None:
+                        SLEEP_OVERSHOOT_SECONDS.observe(max(0.0, FRAME_SCHEDULER.last_overshoot))
+                    frame = (frame + step) % len(canvass)
                 else:
-                    frame = 0
-                    wait_time = 1.0 / 60.0
-                end = timer()
-                EXECUTION_TIME_COUNT += 1
-
-                if end - EXECUTION_TIME_START >= 1:  # Have we measuring one second at least?
-                    if EXECUTION_TIME_COUNT > 1:  # Have we measured one frame at least?
-                        ACHIEVED_FPS = (end - EXECUTION_TIME_START) / EXECUTION_TIME_COUNT
-                    else:
-                        ACHIEVED_FPS = 0.0000001  # "eps"
-
-                time.sleep(wait_time)
+                    # Nothing changes by itself, the schedule starts over when the movie is resumed
+                    RENDER_WAKEUP.wait()
+                    FRAME_SCHEDULER.resume()
             except Exception as e:
                 if exceptions >= 4:
-                    CURRENT_MOVIE = None
+                    RENDER_STATE.clear()
                     GLOBAL_GRAPHICS.clear()
                 exceptions += 1
                 print("Exception: ")
@@ -94,39 +213,236 @@ def graphics_main():
         print("Finally")
 
 
+def reconvert_movie(snapshot: MovieSnapshot):
+    if isinstance(snapshot.canvass, LazyCanvasList):
+        canvass = LazyCanvasList(snapshot.movie.frames, GLOBAL_GRAPHICS)
+        canvass[0]
+        canvass.start_prefetch()
+        return canvass
+    return CANVAS_CACHE.convert(snapshot.movie, GLOBAL_GRAPHICS)
+
+
+def brightness_main():
+    """
+    Re-converts the current (and next) movie after brightness changes. The render loop keeps showing the old
+    canvases until the new list is complete and swapped in. Changes arriving during a conversion are coalesced.
+    """
+    while True:
+        BRIGHTNESS_CHANGED.wait()
+        BRIGHTNESS_CHANGED.clear()
+        try:
+            for snapshot in (RENDER_STATE.current, RENDER_STATE.pending):
+                if snapshot is None:
+                    continue
+                canvass = reconvert_movie(snapshot)
+                if RENDER_STATE.replace_canvass(snapshot, canvass):
+                    retired = snapshot.canvass
+                else:
+                    retired = canvass  # the movie was replaced in the meantime
+                if isinstance(retired, LazyCanvasList):
+                    retired.cancel_prefetch()
+        except Exception:
+            print("Exception: ")
+            print(traceback.format_exc())
+
+
 # web_app.on("POST", "/rest/v1/image", request_set_image)
 # web_app.on("POST", "/rest/v1/brightness", request_set_brightness)
 # web_app.on("GET", "/rest/v1/debug/achieved_fps", request_get_achieved_fps)
 # web_app.on("GET", "/rest/v1/debug/fs_writable", request_get_fs_writable)
 # web_app.on("GET", "/rest/v1/debug/memory", request_get_memory)
 
+def load_uploaded_movie(graphics=None) -> Movie:
+    """
+    Reads the movie from the request body, either the binary movie format or an animated GIF / PNG / WebP
+    (by content type) or JSON. JSON is parsed as a stream, the body is never held in memory as a whole.
+    """
+    if request.content_length is not None and request.content_length > UPLOAD_LIMITS.max_bytes:
+        raise MovieTooLarge(f"Movie exceeds {UPLOAD_LIMITS.max_bytes} bytes")
+
+    if request.mimetype in (movie_format.CONTENT_TYPE, 'application/octet-stream'):
+        return load_movie_from_binary_stream(request.stream, graphics, UPLOAD_LIMITS)
+    if request.mimetype in animation.CONTENT_TYPES:
+        return load_movie_from_animation_stream(request.stream, graphics, UPLOAD_LIMITS)
+    return load_movie_from_stream(request.stream, graphics, UPLOAD_LIMITS)
+
+
+def read_uploaded_movie() -> EncodedMovie:
+    """Like load_uploaded_movie, but the frames are only read, not decoded."""
+    if request.content_length is not None and request.content_length > UPLOAD_LIMITS.max_bytes:
+        raise MovieTooLarge(f"Movie exceeds {UPLOAD_LIMITS.max_bytes} bytes")
+
+    if request.mimetype in (movie_format.CONTENT_TYPE, 'application/octet-stream'):
+        return read_encoded_movie_from_binary_stream(request.stream, UPLOAD_LIMITS)
+    if request.mimetype in animation.CONTENT_TYPES:
+        return read_encoded_animation_from_stream(request.stream, UPLOAD_LIMITS, GLOBAL_GRAPHICS.size)
+    return read_encoded_movie_from_stream(request.stream, UPLOAD_LIMITS)
+
+
+def convert_uploaded_movie(job: Job, encoded: EncodedMovie) -> dict:
+    global PUBLISHED_JOB_SERIAL
+    with DECODE_SECONDS.time():
+        temp = encoded.decode(DECODE_POOL, UPLOAD_LIMITS.max_pixels)
+    temp.canvass = CANVAS_CACHE.convert(temp, GLOBAL_GRAPHICS)
+
+    # Jobs may finish out of order, an older upload must not replace a newer one
+    with PUBLISH_LOCK:
+        published = job.serial > PUBLISHED_JOB_SERIAL
+        if published:
+            PUBLISHED_JOB_SERIAL = job.serial
+            RENDER_STATE.publish(temp)
+
+    return {
+        'frames': len(temp.canvass),
+        'unique_frames': temp.unique_frames(),
+        'hash': temp.digest(),
+        'published': published
+    }
+
+
+@app.errorhandler(TooManyJobs)
+def handle_too_many_jobs(e):
+    return {'message': str(e)}, 503
+
+
+@app.errorhandler(CanvasPoolExhausted)
+def handle_canvas_pool_exhausted(e):
+    return {'message': str(e)}, 503
+
+
+@app.errorhandler(MovieTooLarge)
+def handle_movie_too_large(e):
+    return {'message': str(e)}, 413
+
+
+@app.errorhandler(ValueError)
+def handle_invalid_movie(e):
+    return {'message': str(e)}, 400
+
+
 @app.route('/rest/v1/image', methods=['POST'])
 def set_image():
-    global NEXT_MOVIE
-    payload = request.json
-    temp = Movie.load_from_dict(payload)
-    temp.canvass = GLOBAL_GRAPHICS.convert_to_canvas(temp.frames)
-    NEXT_MOVIE = temp
+    """
+    Only reads the upload and answers with a job id, decoding and conversion happen in the background.
+    The movie is shown as soon as the job is done. With ?wait=<seconds> the request waits for the job.
+    """
+    encoded = read_uploaded_movie()
+    UPLOAD_BYTES.observe(encoded.size)
+    job = JOBS.submit(convert_uploaded_movie, encoded)
+
+    wait = request.args.get('wait', type=float)
+    if wait is not None and job.wait(wait):
+        status = 200 if job.status == 'done' else 400
+        return job.to_dict(), status
+
+    return {
+        'job': job.id,
+        'frames': len(encoded),
+        'message': 'accepted'
+    }, 202
+
+
+@app.route('/rest/v1/jobs/<job_id>')
+def get_job(job_id):
+    """With ?wait=<seconds> the request blocks until the job is finished or the time is up (long poll)."""
+    job = JOBS.get(job_id)
+    if job is None:
+        return {'message': 'Unknown job'}, 404
+
+    wait = request.args.get('wait', type=float)
+    if wait is not None:
+        job.wait(min(wait, 60.0))
+
+    return job.to_dict()
+
+
+@app.route('/rest/v1/image/<digest>', methods=['POST'])
+def set_image_by_hash(digest):
+    """
+    Shows a movie again without uploading it, if it is still in the canvas cache or in the movie store.
+    Stored movies can also be referenced by name.
+    """
+    cached = CANVAS_CACHE.find_movie(digest)
+    if cached is not None:
+        temp = Movie(cached.fps, cached.frames, cached.durations)
+        temp.canvass = CANVAS_CACHE.convert(temp, GLOBAL_GRAPHICS)
+        RENDER_STATE.publish(temp)
+    else:
+        temp = MOVIE_STORE.load(digest, GLOBAL_GRAPHICS)
+        if temp is None:
+            return {'message': 'Unknown movie, upload it again'}, 404
+        show_mapped_movie(temp)
 
     return {
-        'frames': len(NEXT_MOVIE.canvass),
+        'frames': len(temp.canvass),
+        'unique_frames': temp.unique_frames(),
+        'hash': temp.digest(),
         'message': 'ok'
     }
 
 
+def prepare_movie(movie: Movie) -> Movie:
+    """A Movie for the render loop with canvases for the current settings."""
+    temp = Movie(movie.fps, movie.frames, movie.durations)
+    temp.canvass = CANVAS_CACHE.convert(movie, GLOBAL_GRAPHICS)
+    return temp
+
+
+PLAYLIST = Playlist(prepare_movie, RENDER_STATE.publish, settings=lambda: GLOBAL_GRAPHICS.cache_key())
+
+
+@app.route('/rest/v1/playlist', methods=['POST', 'GET', 'DELETE'])
+def set_get_playlist():
+    """
+    POST replaces the playlist: {"entries": [{"movie": {"fps": ..., "frames": [...]} or "hash": "<cached or stored
+    movie, or the name of a stored movie>", "duration": seconds, "repeat": count, "start": "HH:MM", "end": "HH:MM"},
+    ...]}
+    """
+    if request.method == 'POST':
+        if request.content_length is not None and request.content_length > UPLOAD_LIMITS.max_bytes:
+            raise MovieTooLarge(f"Playlist exceeds {UPLOAD_LIMITS.max_bytes} bytes")
+
+        playlist = request.get_json(silent=True)
+        if not isinstance(playlist, dict) or not isinstance(playlist.get('entries'), list):
+            return {'message': "Playlist has to be an object with a list of entries"}, 400
+
+        entries = list()
+        for data in playlist['entries']:
+            if not isinstance(data, dict) or ('hash' not in data and 'movie' not in data):
+                return {'message': "Every playlist entry needs a movie or a hash"}, 400
+            if 'hash' in data:
+                movie = CANVAS_CACHE.find_movie(data['hash']) or MOVIE_STORE.load(data['hash'])
+                if movie is None:
+                    return {'message': f"Unknown movie {data['hash']}, upload it again"}, 404
+            else:
+                # The same limits as uploads, the frames are decoded in parallel like those of an upload
+                encoded = read_encoded_movie_from_dict(data['movie'], UPLOAD_LIMITS)
+                movie = encoded.decode(DECODE_POOL, UPLOAD_LIMITS.max_pixels)
+            entries.append(PlaylistEntry.from_dict(data, movie))
+
+        print(f"Set playlist with {len(entries)} entries")
+        PLAYLIST.set_entries(entries)
+    elif request.method == 'DELETE':
+        PLAYLIST.clear()
+
+    return {
+        'entries': [entry.to_dict() for entry in PLAYLIST.entries],
+        'current': PLAYLIST.current
+    }
+
+
 @app.route('/rest/v1/brightness', methods=['POST', 'GET'])
 def set_brightness():
-    global BRIGHTNESS, CURRENT_MOVIE, NEXT_MOVIE
+    global BRIGHTNESS
     if request.method == 'POST':
         temp = max(0, min(100, int(request.data)))
         print(f"Set brightness to {temp}")
         BRIGHTNESS = temp
         GLOBAL_GRAPHICS.set_brightness(BRIGHTNESS)
+        COMPOSITOR.invalidate()
 
-        # Re-convert current movie
-        if CURRENT_MOVIE:
-            new_canvass = GLOBAL_GRAPHICS.convert_to_canvas(CURRENT_MOVIE.frames)
-            CURRENT_MOVIE.canvass = new_canvass
+        # Re-convert current movie in the background
+        BRIGHTNESS_CHANGED.set()
 
     return {
         'brightness': BRIGHTNESS
@@ -135,16 +451,15 @@ def set_brightness():
 
 @app.route('/rest/v1/fps', methods=['POST', 'GET'])
 def set_get_fps():
-    global CURRENT_MOVIE
     if request.method == 'POST':
-        temp = max(0, min(60, int(request.data)))
+        temp = max(0, min(MAX_FPS, int(request.data)))
         print(f"Set fps to {temp}")
-        if CURRENT_MOVIE:
-            CURRENT_MOVIE.fps = temp
+        RENDER_STATE.set_fps(temp)
 
     fps = -1
-    if CURRENT_MOVIE:
-        fps = CURRENT_MOVIE.fps
+    snapshot = RENDER_STATE.latest()
+    if snapshot:
+        fps = snapshot.fps
 
     return {
         'fps': fps
@@ -153,40 +468,162 @@ def set_get_fps():
 
 @app.route('/rest/v1/clear')
 def do_clear():
-    global CURRENT_MOVIE, GLOBAL_GRAPHICS
-    CURRENT_MOVIE = None
-    GLOBAL_GRAPHICS.clear()
+    # The render loop clears the panel as soon as it notices
+    RENDER_STATE.clear()
     return {}
 
 
 @app.route('/rest/v1/debug')
 def get_debug():
-    global ACHIEVED_FPS
-    fps = -1
-    if ACHIEVED_FPS > 0 or ACHIEVED_FPS < 0:
-        fps = 1 / ACHIEVED_FPS
+    return {
+        'panel': PANEL_CONFIG.to_dict(),
+        'fps': ACHIEVED_FPS.rate(),
+        'frame_timing': FRAME_SCHEDULER.stats(),
+        'compositor': COMPOSITOR.stats(),
+        'stream': FRAME_STREAM.stats(),
+        'canvas_cache': CANVAS_CACHE.stats(),
+        'canvas_pool': GLOBAL_GRAPHICS.pool.stats() if GLOBAL_GRAPHICS.pool is not None else None,
+        'jobs': JOBS.stats()
+    }
+
+
+@app.route('/metrics')
+def get_metrics():
+    """Prometheus scrape endpoint."""
+    return metrics.REGISTRY.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+
+@app.route('/rest/v1/frame_policy', methods=['POST', 'GET'])
+def set_get_frame_policy():
+    if request.method == 'POST':
+        temp = request.data.decode('utf-8').strip()
+        if temp not in POLICIES:
+            return {'message': f"Unknown frame policy, expected one of {', '.join(POLICIES)}"}, 400
+        print(f"Set frame policy to {temp}")
+        FRAME_SCHEDULER.policy = temp
 
     return {
-        'fps': 1 / ACHIEVED_FPS
+        'frame_policy': FRAME_SCHEDULER.policy
     }
 
 
+@app.route('/rest/v1/movies', methods=['POST', 'GET'])
+def store_list_movies():
+    """
+    POST stores the uploaded movie (any upload format) in the movie store, ?name=<name> names it.
+    GET lists the stored movies.
+    """
+    if request.method == 'POST':
+        temp = load_uploaded_movie()
+        digest = MOVIE_STORE.put(temp, request.args.get('name'))
+        print(f"Stored movie {digest}")
+        return {
+            'hash': digest,
+            'frames': len(temp.frames),
+            'message': 'ok'
+        }
+
+    return {
+        'movies': MOVIE_STORE.entries()
+    }
+
+
+@app.route('/rest/v1/movies/<ref>', methods=['DELETE'])
+def delete_movie(ref):
+    if not MOVIE_STORE.delete(ref):
+        return {'message': 'Unknown movie'}, 404
+    return {
+        'message': 'ok'
+    }
+
+
+@app.route('/rest/v1/zones', methods=['GET', 'DELETE'])
+def list_clear_zones():
+    """While there are zones, they are shown instead of the movie. DELETE removes all of them."""
+    if request.method == 'DELETE':
+        COMPOSITOR.clear()
+
+    return {
+        'zones': [zone.to_dict() for zone in COMPOSITOR.zones]
+    }
+
+
+@app.route('/rest/v1/zones/<name>', methods=['POST', 'DELETE'])
+def set_delete_zone(name):
+    """
+    POST adds or replaces a zone: {"x": 0, "y": 0, "width": 32, "height": 16, "hash": "<cached or stored movie, or
+    the name of a stored movie>", "fps": <optional, the fps of the movie by default>}, or instead of "hash" a
+    "clock": {"format": "%H:%M", "color": [255, 255, 255]}.
+    """
+    if request.method == 'DELETE':
+        if not COMPOSITOR.remove_zone(name):
+            return {'message': 'Unknown zone'}, 404
+        return {
+            'message': 'ok'
+        }
+
+    data = request.json
+    try:
+        x, y, width, height = (int(data[key]) for key in ('x', 'y', 'width', 'height'))
+    except (KeyError, TypeError):
+        return {'message': 'A zone needs x, y, width and height'}, 400
+    COMPOSITOR.check_bounds(x, y, width, height)
+
+    if 'clock' in data:
+        clock = data['clock']
+        if not isinstance(clock, dict) or not isinstance(clock.get('format', ''), str) \
+                or not isinstance(clock.get('color', []), list):
+            return {'message': 'A clock needs to be {"format": "<strftime format>", "color": [r, g, b]}'}, 400
+        source = ClockSource((width, height), clock.get('format', '%H:%M'), tuple(clock.get('color', (255, 255, 255))))
+    elif 'hash' in data:
+        if not isinstance(data['hash'], str):
+            return {'message': 'Zone hash has to be a string'}, 400
+        movie = CANVAS_CACHE.find_movie(data['hash']) or MOVIE_STORE.load(data['hash'])
+        if movie is None:
+            return {'message': f"Unknown movie {data['hash']}, upload it again"}, 404
+        fps = data.get('fps')
+        if fps is not None and (isinstance(fps, bool) or not isinstance(fps, (int, float))):
+            return {'message': 'Zone fps has to be a number'}, 400
+        source = MovieSource(movie, (width, height), max(0, min(MAX_FPS, int(fps))) if fps is not None else None)
+    else:
+        return {'message': 'A zone needs a "hash" or a "clock"'}, 400
+
+    zone = Zone(name, x, y, width, height, source)
+    COMPOSITOR.set_zone(zone)
+    print(f"Set zone {name} at {x},{y} {width}x{height}")
+    return zone.to_dict()
+
+
 @app.route('/rest/v1/default_movie', methods=['POST'])
 def store_default_movie():
     # Sanity check data - do try to load it first
-    payload = request.json
-    temp = Movie.load_from_dict(payload)
+    temp = load_uploaded_movie()
+
+    # Replaced atomically, the current file might still be memory mapped
+    movie_format.write_atomic(DEFAULT_MOVIE, temp.save_to_binary())
 
-    with open('default.movie', 'w+') as f:
-        f.write(temp.save_to_json())
+    return {
+        'frames': len(temp.frames),
+        'message': 'ok'
+    }
 
 
-@app.route('/rest/v1/default_movie', methods=['POST'])
+@app.route('/rest/v1/default_movie', methods=['GET'])
 def load_default_movie():
     swap_to_default_movie()
 
+    return {
+        'message': 'ok'
+    }
+
 
 swap_to_default_movie()
 
 g_thread = threading.Thread(target=graphics_main, daemon=True)
 g_thread.start()
+
+b_thread = threading.Thread(target=brightness_main, daemon=True)
+b_thread.start()
+
+p_thread = threading.Thread(target=PLAYLIST.run, daemon=True)
+p_thread.start()
@@ -0,0 +1,302 @@
+"""
+Headless benchmarks of the conversion pipeline and the render loop, on the mock graphics.
+
+    python benchmark.py --output bench.json
+
+Runs from a temporary directory, so an existing default.movie is not touched. All results are written as JSON.
+With --device, the safe and the unsafe SetImage are also compared on the real panel.
+
+    python benchmark.py --fuzz-only --fuzz 5000
+
+Only pushes odd frames through the canvas conversion, without the benchmarks. Both runs exit with 1 if a fuzzed
+frame was neither converted to a canvas of the panel size nor rejected with a ValueError.
+"""
+import argparse
+import base64
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+from graphics_mock import Movie, Graphics as GraphicsMock, canvas_image
+from panel_config import PanelConfig, FITS, ROTATIONS
+
+PANEL_SIZE = (128, 64)
+MOVIE_SIZES = (1, 10, 100, 500)
+
+
+class InstrumentedGraphics(GraphicsMock):
+    """Mock graphics which simulates the cost of SwapOnVSync and logs every displayed canvas."""
+
+    def __init__(self, brightness: int, swap_cost: float = 0.0):
+        super().__init__(brightness)
+        self.swap_cost = swap_cost
+        self.displayed = list()  # (time.monotonic(), canvas)
+        self._displayed_changed = threading.Condition()
+
+    def display_canvas(self, canvas):
+        if self.swap_cost > 0:
+            # Busy wait, the real SwapOnVSync blocks the calling thread until the next refresh
+            end = time.monotonic() + self.swap_cost
+            while time.monotonic() < end:
+                pass
+        with self._displayed_changed:
+            self.displayed.append((time.monotonic(), canvas))
+            self._displayed_changed.notify_all()
+
+    def wait_for_display(self, canvass, since: float, timeout: float = 10.0) -> float:
+        """Time of the first display of one of the canvases after `since`, or None."""
+        ids = set(id(canvas) for canvas in canvass)
+        deadline = time.monotonic() + timeout
+        with self._displayed_changed:
+            while True:
+                for displayed_at, canvas in self.displayed:
+                    if displayed_at >= since and id(canvas) in ids:
+                        return displayed_at
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._displayed_changed.wait(remaining)
+
+    def displays_between(self, start: float, end: float) -> list:
+        with self._displayed_changed:
+            return [displayed_at for displayed_at, _ in self.displayed if start <= displayed_at < end]
+
+
+def make_frames(count: int, size=PANEL_SIZE, colors: int = 16, seed: int = 42) -> list:
+    """Pixel art like frames: a small palette and large areas of the same color."""
+    rng = np.random.default_rng(seed)
+    palette = rng.integers(0, 256, size=(colors, 3), dtype=np.uint8)
+    frames = list()
+    for i in range(count):
+        blocks = rng.integers(0, colors, size=(size[1] // 8, size[0] // 8))
+        indices = np.kron(blocks, np.ones((8, 8), dtype=np.int64))
+        frames.append(Image.fromarray(palette[indices], 'RGB'))
+    return frames
+
+
+def make_movie_json(count: int, fps: int = 30) -> str:
+    encoded = list()
+    for frame in make_frames(count):
+        with io.BytesIO() as f:
+            frame.save(f, format='PNG')
+            encoded.append(base64.b64encode(f.getvalue()).decode('ascii'))
+    return json.dumps({'fps': fps, 'frames': encoded})
+
+
+def bench_decode(sizes) -> list:
+    results = list()
+    for count in sizes:
+        payload = json.loads(make_movie_json(count))
+        start = time.perf_counter()
+        Movie.load_from_dict(payload)
+        elapsed = time.perf_counter() - start
+        results.append({'frames': count, 'seconds': elapsed, 'frames_per_second': count / elapsed})
+    return results
+
+
+def bench_convert(sizes, graphics) -> list:
+    results = list()
+    for count in sizes:
+        movie = Movie(30, make_frames(count))
+        arrays = movie.frame_arrays()
+        start = time.perf_counter()
+        graphics.convert_to_canvas(arrays)
+        elapsed = time.perf_counter() - start
+        results.append({'frames': count, 'seconds': elapsed, 'frames_per_second': count / elapsed})
+    return results
+
+
+def bench_upload_latency(app, graphics, sizes) -> list:
+    """From the start of the upload request until the first frame of the movie is displayed."""
+    client = app.app.test_client()
+    results = list()
+    for count in sizes:
+        body = make_movie_json(count, fps=30)
+        start = time.monotonic()
+        response = client.post('/rest/v1/image?wait=60', data=body)
+        if response.status_code != 200:
+            raise RuntimeError(f"Upload failed: {response.get_json()}")
+        canvass = app.RENDER_STATE.latest().canvass
+        displayed_at = graphics.wait_for_display(canvass, start)
+        results.append({
+            'frames': count,
+            'bytes': len(body),
+            'seconds': displayed_at - start if displayed_at is not None else None,
+        })
+    return results
+
+
+def bench_fps_accuracy(app, graphics, fps_values, duration: float) -> list:
+    """Sustained frame rate of graphics_main compared to the fps of the movie."""
+    results = list()
+    for fps in fps_values:
+        movie = Movie(fps, make_frames(max(2, fps)))
+        movie.canvass = graphics.convert_to_canvas(movie.frame_arrays())
+        app.RENDER_STATE.publish(movie)
+        if graphics.wait_for_display(movie.canvass, time.monotonic() - 1.0) is None:
+            raise RuntimeError("Render loop did not display the movie")
+
+        time.sleep(0.5)  # settle
+        dropped_before = app.FRAME_SCHEDULER.dropped_frames
+        start = time.monotonic()
+        time.sleep(duration)
+        displays = graphics.displays_between(start, start + duration)
+        intervals = np.diff(displays) if len(displays) > 1 else np.array([0.0])
+        achieved = len(displays) / duration
+        results.append({
+            'fps': fps,
+            'achieved_fps': achieved,
+            'accuracy': achieved / fps,
+            'dropped_frames': app.FRAME_SCHEDULER.dropped_frames - dropped_before,
+            'interval_mean_ms': float(np.mean(intervals) * 1000.0),
+            'interval_stddev_ms': float(np.std(intervals) * 1000.0),
+            'interval_max_ms': float(np.max(intervals) * 1000.0),
+        })
+    return results
+
+
+FUZZ_MODES = ('1', 'L', 'P', 'LA', 'PA', 'La', 'RGB', 'RGBA', 'RGBX', 'RGBa', 'CMYK', 'YCbCr', 'LAB', 'HSV', 'I', 'F',
+              'I;16')
+
+
+def fuzz_frame(rng):
+    """A frame of an odd size, as an image of any mode or an array which may be non-contiguous or of a wrong type."""
+    width, height = int(rng.integers(0, 160)), int(rng.integers(0, 160))
+    kind = rng.integers(0, 3)
+    if kind == 0:
+        return Image.new(str(rng.choice(FUZZ_MODES)), (width, height), int(rng.integers(0, 256)))
+    if kind == 1:
+        rgb = rng.integers(0, 256, size=(height, width * 2, 3), dtype=np.uint8)
+        return rgb[:, ::2] if rng.integers(0, 2) else rgb[:, :width]
+    values = rng.random((height, width, int(rng.integers(1, 5))))
+    return (values * 255).astype(np.uint8) if rng.integers(0, 2) else values
+
+
+def fuzz_canvas_frames(iterations: int, seed: int = 42) -> dict:
+    """
+    Odd frames through the conversion of the mock with random panel configs. Every frame has to end up as a canvas
+    of exactly the panel size or be rejected with a ValueError, anything else is a failure.
+    """
+    rng = np.random.default_rng(seed)
+    converted = rejected = 0
+    failures = list()
+    for i in range(iterations):
+        # Even columns, the U-mapper can't fold anything else
+        panel = PanelConfig(rows=int(rng.integers(1, 40)), cols=int(rng.integers(1, 40)) * 2,
+                            chain_length=int(rng.integers(1, 4)), pixel_mapper=str(rng.choice(['', 'U-mapper'])),
+                            rotation=int(rng.choice(ROTATIONS)), fit=str(rng.choice(FITS)))
+        graphics = GraphicsMock(int(rng.integers(0, 101)), panel=panel)
+        graphics.pool.capacity = 2
+        frame = fuzz_frame(rng)
+        try:
+            canvas = graphics.convert_to_canvas([frame])[0]
+            canvas = graphics.convert_into(canvas, frame)
+            width, height = panel.size
+            image = canvas_image(canvas.native, panel.size)
+            if canvas.native.shape != (height, width, 3) or image.size != (width, height) or image.mode != 'RGB':
+                raise AssertionError(f"Canvas of {canvas.native.shape} for a panel of {width}x{height}")
+            converted += 1
+        except ValueError:
+            rejected += 1
+        except Exception as e:
+            failures.append({'iteration': i, 'frame': repr(getattr(frame, 'mode', getattr(frame, 'dtype', None))),
+                             'panel': panel.to_dict(), 'error': f"{type(e).__name__}: {e}"})
+    return {'iterations': iterations, 'converted': converted, 'rejected': rejected, 'failures': failures}
+
+
+def bench_set_image(count: int, device: bool) -> dict:
+    """Cost of the validation stage per frame, and of both SetImage paths when running on the panel."""
+    panel = PanelConfig()
+    arrays = [np.asarray(frame) for frame in make_frames(count, panel.size)]
+    start = time.perf_counter()
+    for rgb in arrays:
+        canvas_image(rgb, panel.size)
+    results = {'frames': count, 'validate_ms': (time.perf_counter() - start) / count * 1000.0}
+    if not device:
+        return results
+
+    import graphics_rgb
+    graphics = graphics_rgb.Graphics(100, panel=panel)
+    graphics.pool.capacity = max(graphics.pool.capacity, count + 2)
+    results['unsafe_supported'] = graphics_rgb.unsafe_set_image_supported()
+    for unsafe in (False, True) if results['unsafe_supported'] else (False,):
+        graphics.unsafe_set_image = unsafe
+        start = time.perf_counter()
+        graphics.convert_to_canvas(arrays)
+        results['unsafe_ms' if unsafe else 'safe_ms'] = (time.perf_counter() - start) / count * 1000.0
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', help="JSON file for the results, stdout if not given")
+    parser.add_argument('--swap-cost', type=float, default=0.002, help="Simulated SwapOnVSync duration in seconds")
+    parser.add_argument('--duration', type=float, default=3.0, help="Seconds to measure each fps value")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(MOVIE_SIZES), help="Movie sizes in frames")
+    parser.add_argument('--fps', type=int, nargs='+', default=[10, 30, 60], help="Frame rates to measure")
+    parser.add_argument('--fuzz', type=int, default=500, help="Odd frames to push through the conversion")
+    parser.add_argument('--fuzz-only', action='store_true', help="Only run the fuzzing of the canvas conversion")
+    parser.add_argument('--device', action='store_true', help="Compare the SetImage paths on the real panel")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    if args.fuzz_only:
+        results = {'canvas_fuzz': fuzz_canvas_frames(args.fuzz)}
+        write_results(results, output)
+        return check_fuzz(results['canvas_fuzz'])
+
+    os.environ['MATRIX_GRAPHICS'] = 'mock'
+    os.chdir(tempfile.mkdtemp(prefix='matrix-benchmark-'))
+
+    # The server logs to stdout, keep it clean for the results
+    with contextlib.redirect_stdout(sys.stderr):
+        import app  # starts the render loop
+        graphics = InstrumentedGraphics(app.BRIGHTNESS, swap_cost=args.swap_cost)
+        app.GLOBAL_GRAPHICS = graphics
+
+        results = {
+            'timestamp': time.time(),
+            'python': sys.version,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'swap_cost': args.swap_cost,
+            'decode': bench_decode(args.sizes),
+            'convert': bench_convert(args.sizes, graphics),
+            'upload_latency': bench_upload_latency(app, graphics, args.sizes),
+            'fps_accuracy': bench_fps_accuracy(app, graphics, args.fps, args.duration),
+            'set_image': bench_set_image(100, args.device),
+            'canvas_fuzz': fuzz_canvas_frames(args.fuzz),
+        }
+
+    write_results(results, output)
+    return check_fuzz(results['canvas_fuzz'])
+
+
+def write_results(results: dict, output: str):
+    text = json.dumps(results, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+def check_fuzz(fuzz: dict) -> int:
+    """Exit code of the run, 1 if any fuzzed frame failed."""
+    if fuzz['failures']:
+        print(f"FAILED: {len(fuzz['failures'])} of {fuzz['iterations']} fuzzed frames", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import metrics
+from graphics_mock import Movie, ColorAdjustment
+
+CONVERT_SECONDS = metrics.histogram('matrix_convert_seconds', 'Time to convert a whole movie to canvases',
+                                    metrics.SECONDS_SLOW)
+
+
+class CanvasCache:
+    """
+    LRU cache of converted canvas lists, keyed by the content digest of the frames and the graphics settings
+    (brightness, geometry) they were converted with. The size of an entry is estimated from the frames and the
+    canvases, least recently used entries are evicted when the byte budget is exceeded.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # (digest, graphics key) -> (movie, canvass, size)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _entry_size(movie: Movie, graphics) -> int:
+        size = 0
+        for rgb in {id(rgb): rgb for rgb in movie.frame_arrays()}.values():  # duplicates share one canvas
+            size += rgb.nbytes + graphics.canvas_bytes((rgb.shape[1], rgb.shape[0]))
+        if isinstance(movie.frames, list):
+            # Decoded frames next to their RGB arrays, when their sizes differ (lazily decoded frames are not kept).
+            # Pillow keeps RGB with 4 bytes per pixel, frames which are arrays are their own RGB array.
+            for frame in {id(frame): frame for frame in movie.frames}.values():
+                if not isinstance(frame, np.ndarray):
+                    size += frame.width * frame.height * 4
+        return size
+
+    def convert(self, movie: Movie, graphics, adjustment: ColorAdjustment = None) -> list:
+        """Returns the canvases for the movie, converting it only if it is not cached for the current settings."""
+        adjustment = adjustment or graphics.adjustment
+        key = (movie.digest(), graphics.cache_key(adjustment))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        # Convert outside of the lock, it might take a while
+        with CONVERT_SECONDS.time():
+            canvass = graphics.convert_to_canvas(movie.frame_arrays(), adjustment)
+        size = self._entry_size(movie, graphics)
+        if size > self.max_bytes:
+            return canvass
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (movie, canvass, size)
+                self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+        return canvass
+
+    def clear(self):
+        """Drops all entries, their canvases go back to the canvas pool unless a movie still shows them."""
+        with self._lock:
+            self.evictions += len(self._entries)
+            self._entries.clear()
+            self.bytes = 0
+
+    def find_movie(self, digest: str):
+        """Returns a cached movie with the given content digest (converted with any settings), or None."""
+        with self._lock:
+            for (entry_digest, _), (movie, _, _) in reversed(self._entries.items()):
+                if entry_digest == digest:
+                    return movie
+        return None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,105 @@
+import gc
+import threading
+import weakref
+from collections import deque
+
+
+class CanvasPoolExhausted(Exception):
+    pass
+
+
+class PooledCanvas:
+    """
+    Handle of a native canvas lent from a CanvasPool. Movies, caches and the render loop hold handles, the native
+    canvas goes back to the pool as soon as its handle is garbage.
+    """
+
+    __slots__ = ('native', '__weakref__')
+
+    def __init__(self, native):
+        self.native = native
+
+
+class CanvasPool:
+    """
+    Fixed number of native canvases. rgbmatrix never frees a canvas once CreateFrameCanvas made it, so canvases
+    of retired movies are handed out again instead of creating new ones. When all canvases are in use, the
+    reclaimers (e.g. clearing the canvas cache) get a chance to release some before acquire fails.
+    """
+
+    def __init__(self, capacity: int, create):
+        self.capacity = capacity
+        self._create = create
+        self._free = list()
+        # Handles die wherever the last reference goes, even in a garbage collection within _take, so released
+        # canvases are only appended here (without the lock) and moved to _free by the next _take
+        self._released = deque()
+        self._lock = threading.Lock()
+        self.reclaimers = list()
+        self.allocated = 0
+        self.in_use = 0
+        self.high_water = 0
+        self.reused = 0
+        self.exhausted = 0
+
+    def _collect_released(self):
+        """Called with the lock held."""
+        while self._released:
+            self._free.append(self._released.popleft())
+            self.in_use -= 1
+
+    def _take(self):
+        with self._lock:
+            self._collect_released()
+            if self._free:
+                self.reused += 1
+                native = self._free.pop()
+            elif self.allocated < self.capacity:
+                self.allocated += 1
+                native = None
+            else:
+                return None
+            self.in_use += 1
+            self.high_water = max(self.high_water, self.in_use)
+        if native is not None:
+            return native
+
+        # Outside of the lock, creating a canvas allocates and might run the garbage collector
+        try:
+            return self._create()
+        except BaseException:
+            with self._lock:
+                self.allocated -= 1
+                self.in_use -= 1
+            raise
+
+    def _release(self, native):
+        self._released.append(native)
+
+    def acquire(self) -> PooledCanvas:
+        native = self._take()
+        if native is None:
+            for reclaim in self.reclaimers:
+                reclaim()
+            gc.collect()  # handles kept alive by reference cycles
+            native = self._take()
+            if native is None:
+                self.exhausted += 1
+                raise CanvasPoolExhausted(f"All {self.capacity} canvases are in use")
+
+        canvas = PooledCanvas(native)
+        weakref.finalize(canvas, self._release, native)
+        return canvas
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._collect_released()
+            return {
+                'capacity': self.capacity,
+                'allocated': self.allocated,
+                'in_use': self.in_use,
+                'free': len(self._free),
+                'high_water': self.high_water,
+                'reused': self.reused,
+                'exhausted': self.exhausted,
+            }
@@ -0,0 +1,232 @@
+import bisect
+import threading
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+import animation
+from frame_scheduler import MIN_FRAME_SECONDS
+from graphics_mock import Movie, frame_to_array
+
+
+class MovieSource:
+    """
+    Frames of a movie fit into a zone, played on their own clock. The frames are fit to the zone once, so a tick
+    only has to look up the current frame.
+    """
+
+    def __init__(self, movie: Movie, size: tuple, fps: int = None, clock=time.monotonic):
+        fitted = dict()  # id of the movie frame -> array, duplicate frames share theirs
+        frames = movie.shared_frames()
+        for frame in frames:
+            if id(frame) not in fitted:
+                image = frame if not isinstance(frame, np.ndarray) else Image.fromarray(frame)
+                fitted[id(frame)] = frame_to_array(animation.fit_to_panel(animation.flatten(image), size))
+        self.frames = [fitted[id(frame)] for frame in frames]
+        self.keys = [id(fitted[id(frame)]) for frame in frames]  # the same key is not drawn twice in a row
+
+        durations = movie.frame_seconds(fps if fps is not None else movie.fps)
+        if durations is None or len(frames) < 2:
+            self.ends = None  # paused or a still image
+        else:
+            self.ends = list()  # end of every frame, relative to the start of a loop
+            end = 0.0
+            for duration in durations:
+                end += max(MIN_FRAME_SECONDS, duration)
+                self.ends.append(end)
+        self.start = clock()
+
+    def frame(self, now: float) -> tuple:
+        """(key, rgb, time of the next change or None)"""
+        if self.ends is None:
+            return self.keys[0], self.frames[0], None
+
+        total = self.ends[-1]
+        loops, position = divmod(now - self.start, total)
+        i = min(bisect.bisect_right(self.ends, position), len(self.frames) - 1)
+        return self.keys[i], self.frames[i], self.start + loops * total + self.ends[i]
+
+
+class ClockSource:
+    """The wall clock as text (strftime format), redrawn when the text changes."""
+
+    def __init__(self, size: tuple, format: str = '%H:%M', color: tuple = (255, 255, 255)):
+        if len(color) != 3 or not all(isinstance(c, int) and 0 <= c <= 255 for c in color):
+            raise ValueError("Clock color has to be [r, g, b] with values from 0 to 255")
+        self.size = tuple(size)
+        self.format = format
+        self.color = tuple(color)
+        self.font = ImageFont.load_default()
+        self._text = None
+        self._rgb = None
+
+    def frame(self, now: float) -> tuple:
+        wall = time.time()
+        text = time.strftime(self.format, time.localtime(wall))
+        if text != self._text:
+            image = Image.new('RGB', self.size)
+            draw = ImageDraw.Draw(image)
+            left, top, right, bottom = draw.textbbox((0, 0), text, font=self.font)
+            position = ((self.size[0] - (right - left)) // 2 - left, (self.size[1] - (bottom - top)) // 2 - top)
+            draw.text(position, text, fill=self.color, font=self.font)
+            self._text = text
+            self._rgb = frame_to_array(image)
+        # The text can only change with the next full second
+        return self._text, self._rgb, now + (1.0 - wall % 1.0)
+
+
+class Zone:
+    """A named rectangle of the panel, showing the frames of its source. Later zones are drawn on top."""
+
+    def __init__(self, name: str, x: int, y: int, width: int, height: int, source):
+        self.name = name
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.source = source
+
+    def overlaps(self, other) -> bool:
+        return (self.x < other.x + other.width and other.x < self.x + self.width and
+                self.y < other.y + other.height and other.y < self.y + self.height)
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'x': self.x,
+            'y': self.y,
+            'width': self.width,
+            'height': self.height,
+            'source': type(self.source).__name__,
+        }
+
+
+class Compositor:
+    """
+    Composites the zones into one frame of the panel and converts it into one canvas per change.
+
+    Every zone keeps the key of the frame it last drew into the composed frame, a tick only copies the zones
+    whose frame changed (and the zones on top of them), and converts the composed frame only if anything changed.
+    Zones prepare their frames up front, so a tick is a few array copies and a single conversion, well within the
+    frame budget. Two canvases are used in turns, the one on the panel is never written to.
+    """
+
+    def __init__(self, graphics, size: tuple, clock=time.monotonic, wakeup: threading.Event = None):
+        self.graphics = graphics
+        self.size = tuple(size)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._zones = dict()  # name -> Zone, in drawing order
+        self._drawn = dict()  # name -> key of the frame in the composed frame
+        self._redraw = True
+        self._frame = np.zeros((self.size[1], self.size[0], 3), dtype=np.uint8)
+        self._canvass = [None, None]
+        self._next_canvas = 0
+        self.next_change = None  # when the next zone changes its frame, None if no zone ever will
+        self.changed = wakeup or threading.Event()  # set when zones change, the render loop ticks right away
+        self.ticks = 0
+        self.composed_frames = 0
+        self.zone_updates = 0
+        self.over_budget = 0
+        self.last_compose_seconds = 0.0
+
+    @property
+    def active(self) -> bool:
+        return len(self._zones) > 0
+
+    @property
+    def zones(self) -> list:
+        with self._lock:
+            return list(self._zones.values())
+
+    def check_bounds(self, x: int, y: int, width: int, height: int):
+        """Raises a ValueError if the rectangle is not a zone within the panel."""
+        if width < 1 or height < 1 or x < 0 or y < 0 or x + width > self.size[0] or y + height > self.size[1]:
+            raise ValueError(f"Zone does not fit into the panel of {self.size[0]}x{self.size[1]}")
+
+    def set_zone(self, zone: Zone):
+        """Adds the zone, or replaces the zone of the same name (which keeps its place in the drawing order)."""
+        self.check_bounds(zone.x, zone.y, zone.width, zone.height)
+        with self._lock:
+            self._zones[zone.name] = zone
+            self._redraw = True
+        self.changed.set()
+
+    def remove_zone(self, name: str) -> bool:
+        with self._lock:
+            removed = self._zones.pop(name, None) is not None
+            self._redraw = True
+        self.changed.set()
+        return removed
+
+    def clear(self):
+        with self._lock:
+            self._zones.clear()
+            self._redraw = True
+        self.changed.set()
+
+    def invalidate(self):
+        """Converts the composed frame again on the next tick, e.g. after a brightness change."""
+        with self._lock:
+            self._redraw = True
+        self.changed.set()
+
+    def tick(self):
+        """
+        Brings the composed frame up to date. Returns a canvas to display, or None if nothing changed.
+        Also updates next_change.
+        """
+        start = self._clock()
+        with self._lock:
+            zones = list(self._zones.values())
+            redraw = self._redraw
+            self._redraw = False
+
+        if redraw:
+            self._frame[:] = 0
+            self._drawn.clear()
+
+        drawn = list()  # zones copied in this tick, zones on top of them have to be copied again
+        next_change = None
+        for zone in zones:
+            key, rgb, change = zone.source.frame(start)
+            if change is not None:
+                next_change = change if next_change is None else min(next_change, change)
+            if redraw or self._drawn.get(zone.name) != key or any(zone.overlaps(other) for other in drawn):
+                self._frame[zone.y:zone.y + zone.height, zone.x:zone.x + zone.width] = rgb
+                self._drawn[zone.name] = key
+                drawn.append(zone)
+        self.next_change = next_change
+        self.ticks += 1
+        self.zone_updates += len(drawn)
+
+        if not redraw and not drawn:
+            return None
+
+        canvas = self.graphics.convert_into(self._canvass[self._next_canvas], self._frame)
+        self._canvass[self._next_canvas] = canvas
+        self._next_canvas = 1 - self._next_canvas
+        self.composed_frames += 1
+
+        self.last_compose_seconds = self._clock() - start
+        if self.last_compose_seconds > MIN_FRAME_SECONDS:
+            self.over_budget += 1
+        return canvas
+
+    def timeout(self):
+        """Seconds until the next tick is due, None if no zone will change by itself."""
+        if self.next_change is None:
+            return None
+        # Never tick faster than the render loop would, even if several zones change right after each other
+        return max(MIN_FRAME_SECONDS, self.next_change - self._clock())
+
+    def stats(self) -> dict:
+        return {
+            'zones': [zone.to_dict() for zone in self.zones],
+            'ticks': self.ticks,
+            'composed_frames': self.composed_frames,
+            'zone_updates': self.zone_updates,
+            'over_budget': self.over_budget,
+            'last_compose_ms': self.last_compose_seconds * 1000.0,
+        }
@@ -0,0 +1,345 @@
+"""
+Asyncio HTTP server for the control API, instead of `flask run`.
+
+    python control_server.py --host 0.0.0.0 --port 5000
+
+All connections are handled by one event loop, request bodies are streamed from the socket into the request
+handlers while they run. The handlers are the routes of app.py, so every /rest/v1 route keeps its JSON contract.
+They run in two thread pools: uploads (and long polls) in one, everything else in the other, so brightness, fps
+or debug requests never wait for a worker busy with a 20 MB upload. Decoding and conversion run in the executors
+of app.py, the render loop keeps its own thread.
+
+Live frames (see frame_stream.py) are pushed as binary messages of a WebSocket on /rest/v1/stream, or as UDP
+datagrams with --udp-port. They go straight into the canvases of the stream, not through Flask.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import io
+import queue
+import struct
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+import numpy as np
+
+import metrics
+from frame_stream import FrameStream, UdpFrameProtocol
+
+MAX_HEADER_BYTES = 64 * 1024
+CONTROL_MAX_BODY = 64 * 1024  # larger (or chunked) request bodies are handled as uploads
+CHUNK_BYTES = 64 * 1024
+BUFFERED_CHUNKS = 16  # the socket is not read further while this many chunks wait for the handler
+
+STREAM_PATH = '/rest/v1/stream'
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+WEBSOCKET_MAX_MESSAGE = 1024 * 1024
+OPCODE_CONTINUATION, OPCODE_TEXT, OPCODE_BINARY = 0x0, 0x1, 0x2
+OPCODE_CLOSE, OPCODE_PING, OPCODE_PONG = 0x8, 0x9, 0xA
+
+REQUEST_SECONDS = metrics.histogram('matrix_control_request_seconds',
+                                    'Time to answer requests which are not uploads, from the end of the headers',
+                                    metrics.SECONDS_FAST)
+
+_END = object()  # end of a request body
+
+
+class BodyStream(io.RawIOBase):
+    """
+    wsgi.input of a request whose body is still being received. The event loop puts chunks, the handler thread
+    reads them. Every chunk taken returns a credit to the event loop, which only reads from the socket with credits
+    (TCP flow control holds the client back otherwise).
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        super().__init__()
+        self._loop = loop
+        self._chunks = queue.Queue()
+        self._chunk = memoryview(b'')
+        self._done = False
+        self.credits = asyncio.Semaphore(BUFFERED_CHUNKS)
+
+    def readable(self) -> bool:
+        return True
+
+    def put(self, chunk):
+        """Called on the event loop with bytes, _END or an exception."""
+        self._chunks.put(chunk)
+
+    def readinto(self, buffer) -> int:
+        if not self._chunk:
+            if self._done:
+                return 0
+            chunk = self._chunks.get()
+            if chunk is _END:
+                self._done = True
+                return 0
+            if isinstance(chunk, Exception):
+                self._done = True
+                raise chunk
+            self._loop.call_soon_threadsafe(self.credits.release)
+            self._chunk = memoryview(chunk)
+
+        n = min(len(buffer), len(self._chunk))
+        buffer[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+
+class HttpError(Exception):
+    def __init__(self, status: str):
+        super().__init__(status)
+        self.status = status
+
+
+def websocket_frame(opcode: int, payload: bytes = b'') -> bytes:
+    """A single, unmasked frame as sent by a server."""
+    if len(payload) < 126:
+        header = struct.pack('>BB', 0x80 | opcode, len(payload))
+    elif len(payload) < 0x10000:
+        header = struct.pack('>BBH', 0x80 | opcode, 126, len(payload))
+    else:
+        header = struct.pack('>BBQ', 0x80 | opcode, 127, len(payload))
+    return header + payload
+
+
+class ControlServer:
+    def __init__(self, wsgi_app, frame_stream: FrameStream = None, control_workers: int = 4, upload_workers: int = 4):
+        self.wsgi_app = wsgi_app
+        self.frame_stream = frame_stream
+        self.control_pool = ThreadPoolExecutor(max_workers=control_workers, thread_name_prefix='control')
+        self.upload_pool = ThreadPoolExecutor(max_workers=upload_workers, thread_name_prefix='upload')
+
+    async def serve(self, host: str, port: int):
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_HEADER_BYTES)
+        print(f"Control server listening on {', '.join(str(s.getsockname()) for s in server.sockets)}")
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except asyncio.IncompleteReadError:
+                    return  # closed between requests
+                except asyncio.LimitOverrunError:
+                    raise HttpError('431 Request Header Fields Too Large')
+                keep_alive = await self.handle_request(head, reader, writer)
+        except HttpError as e:
+            await self._write_response(writer, e.status, [('Content-Type', 'text/plain')], [e.status.encode()], False)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            print("Exception: ")
+            print(traceback.format_exc())
+        finally:
+            writer.close()
+
+    async def handle_request(self, head: bytes, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        """Answers one request, returns whether the connection can be kept alive."""
+        start = time.monotonic()
+        try:
+            request_line, *header_lines = head[:-4].decode('latin-1').split('\r\n')
+            method, target, version = request_line.split(' ')
+            headers = [tuple(v.strip() for v in line.split(':', 1)) for line in header_lines]
+            headers = {name.lower(): value for name, value in headers}
+        except ValueError:
+            raise HttpError('400 Bad Request')
+
+        path, _, query = target.partition('?')
+        chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise HttpError('400 Bad Request')
+        keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+        if path == STREAM_PATH and headers.get('upgrade', '').lower() == 'websocket':
+            if self.frame_stream is None or 'sec-websocket-key' not in headers:
+                raise HttpError('400 Bad Request')
+            await self.handle_websocket(headers['sec-websocket-key'], reader, writer)
+            return False
+
+        loop = asyncio.get_running_loop()
+        body = BodyStream(loop)
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path, 'latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': writer.get_extra_info('sockname')[0],
+            'SERVER_PORT': str(writer.get_extra_info('sockname')[1]),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': (writer.get_extra_info('peername') or ('', 0))[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BufferedReader(body, CHUNK_BYTES),
+            'wsgi.input_terminated': chunked,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in headers.items():
+            key = name.upper().replace('-', '_')
+            if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[key] = value
+            elif key != 'TRANSFER_ENCODING':
+                environ['HTTP_' + key] = value
+
+        upload = chunked or length > CONTROL_MAX_BODY or 'wait=' in query
+        if headers.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+        pump = asyncio.ensure_future(self._pump_body(reader, body, None if chunked else length, chunked))
+        try:
+            pool = self.upload_pool if upload else self.control_pool
+            status, response_headers, response_body = await loop.run_in_executor(pool, self._run_wsgi, environ)
+        finally:
+            if not pump.done():
+                # The handler did not read the whole body, the rest of it can't be skipped reliably
+                pump.cancel()
+                body.put(_END)
+                keep_alive = False
+
+        if pump.done() and not pump.cancelled() and pump.exception() is not None:
+            keep_alive = False
+        await self._write_response(writer, status, response_headers, response_body, keep_alive)
+        if not upload:
+            REQUEST_SECONDS.observe(time.monotonic() - start)
+        return keep_alive
+
+    async def handle_websocket(self, key: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Every binary message is one frame for the frame stream (RFC 6455, without extensions)."""
+        accept = base64.b64encode(hashlib.sha1(key.encode('latin-1') + WEBSOCKET_GUID).digest()).decode()
+        writer.write(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                      f'Sec-WebSocket-Accept: {accept}\r\n\r\n').encode('latin-1'))
+        print("Live stream connected")
+
+        # No valid frame is larger than this, longer messages are refused before they are read
+        max_message = min(WEBSOCKET_MAX_MESSAGE, self.frame_stream.max_frame_bytes)
+        message = None  # opcode, parts and length of a fragmented message
+        while True:
+            first, second = await reader.readexactly(2)
+            opcode = first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length, = struct.unpack('>H', await reader.readexactly(2))
+            elif length == 127:
+                length, = struct.unpack('>Q', await reader.readexactly(8))
+            total = length + (message[2] if opcode == OPCODE_CONTINUATION and message is not None else 0)
+            if not second & 0x80 or total > max_message:
+                # Clients have to mask their frames
+                writer.write(websocket_frame(OPCODE_CLOSE, struct.pack('>H', 1002 if total <= max_message else 1009)))
+                await writer.drain()
+                return
+            mask = np.frombuffer(await reader.readexactly(4), dtype=np.uint8)
+            payload = np.frombuffer(await reader.readexactly(length), dtype=np.uint8)
+            payload = (payload ^ np.resize(mask, length)).tobytes()
+
+            if opcode == OPCODE_CLOSE:
+                writer.write(websocket_frame(OPCODE_CLOSE, payload[:2]))
+                await writer.drain()
+                print("Live stream disconnected")
+                return
+            if opcode == OPCODE_PING:
+                writer.write(websocket_frame(OPCODE_PONG, payload))
+                await writer.drain()
+                continue
+            if opcode == OPCODE_PONG:
+                continue
+
+            if opcode != OPCODE_CONTINUATION:
+                message = (opcode, [payload], length)
+            elif message is not None:
+                message[1].append(payload)
+                message = (message[0], message[1], total)
+            if first & 0x80 and message is not None:
+                opcode, parts, _ = message
+                message = None
+                if opcode == OPCODE_BINARY:
+                    self.frame_stream.push(b''.join(parts))
+
+    async def _pump_body(self, reader: asyncio.StreamReader, body: BodyStream, length: int, chunked: bool):
+        try:
+            if chunked:
+                while True:
+                    size_line = await reader.readuntil(b'\r\n')
+                    size = int(size_line.split(b';')[0], 16)
+                    if size == 0:
+                        while await reader.readuntil(b'\r\n') != b'\r\n':
+                            pass  # trailers
+                        break
+                    await self._pump_bytes(reader, body, size)
+                    await reader.readexactly(2)
+            else:
+                await self._pump_bytes(reader, body, length)
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+            body.put(OSError(f"Request body incomplete: {e}"))
+            raise
+        body.put(_END)
+
+    async def _pump_bytes(self, reader: asyncio.StreamReader, body: BodyStream, remaining: int):
+        while remaining > 0:
+            await body.credits.acquire()
+            chunk = await reader.read(min(remaining, CHUNK_BYTES))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b'', remaining)
+            remaining -= len(chunk)
+            body.put(chunk)
+
+    def _run_wsgi(self, environ: dict) -> tuple:
+        """Runs in a pool thread. Responses of the control API are small, they are collected completely."""
+        started = list()
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            response_body = [bytes(part) for part in result]
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return started[0], started[1], response_body
+
+    async def _write_response(self, writer: asyncio.StreamWriter, status: str, headers: list, body: list,
+                              keep_alive: bool):
+        length = sum(len(part) for part in body)
+        lines = [f'HTTP/1.1 {status}']
+        lines.extend(f'{name}: {value}' for name, value in headers
+                     if name.lower() not in ('content-length', 'transfer-encoding', 'connection'))
+        lines.append(f'Content-Length: {length}')
+        lines.append('Connection: keep-alive' if keep_alive else 'Connection: close')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        writer.writelines(body)
+        await writer.drain()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--udp-port', type=int, help="Receive live frames as UDP datagrams on this port")
+    args = parser.parse_args()
+
+    import app  # starts the render, brightness and playlist threads
+    asyncio.run(serve(ControlServer(app.app, app.FRAME_STREAM), args.host, args.port, args.udp_port))
+
+
+async def serve(server: ControlServer, host: str, port: int, udp_port: int = None):
+    if udp_port is not None:
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: UdpFrameProtocol(server.frame_stream), local_addr=(host, udp_port))
+        print(f"Receiving live frames on UDP port {udp_port}")
+    await server.serve(host, port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import threading
+import time
+
+# What to do when the render loop falls behind its frame deadlines:
+# - skip:   drop the frames whose display time already passed, so the movie stays in sync with the wall clock
+# - repeat: show every frame (the late one stays on the panel longer) and shift all later deadlines
+POLICY_SKIP = 'skip'
+POLICY_REPEAT = 'repeat'
+POLICIES = (POLICY_SKIP, POLICY_REPEAT)
+
+MAX_FPS = 60.0
+MIN_FRAME_SECONDS = 1.0 / MAX_FPS
+
+
+class FrameScheduler:
+    """
+    Paces the render loop against absolute frame deadlines on a monotonic clock, instead of sleeping a fixed
+    amount after the work is done. The deadline of a frame is the deadline of the previous one plus the display
+    duration of the previous one, so every frame can have its own duration and the loop sleeps once per frame.
+    Time spent in SwapOnVSync and friends is absorbed into the frame duration and does not accumulate as drift.
+    """
+
+    def __init__(self, policy: str = POLICY_SKIP, clock=time.monotonic, sleep=time.sleep):
+        self.policy = policy
+        self._clock = clock
+        self._sleep = sleep
+        self.last_deadline = 0.0  # deadline of the frame to be displayed next, on the scheduler clock
+        self.last_overshoot = None  # how much the last sleep overshot its deadline, None if it did not sleep
+        self.reset_stats()
+
+    @property
+    def policy(self) -> str:
+        return self._policy
+
+    @policy.setter
+    def policy(self, policy: str):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown frame policy {policy}, expected one of {POLICIES}")
+        self._policy = policy
+
+    def reset_stats(self):
+        self.frames = 0
+        self.dropped_frames = 0
+        self.late_frames = 0
+        self.jitter_sum = 0.0
+        self.jitter_max = 0.0
+
+    def start(self):
+        """Anchors the schedule at now, the first frame is expected to be displayed immediately."""
+        self.resume()
+        self.reset_stats()
+
+    def resume(self):
+        """Anchors the schedule at now after a pause, keeping the stats."""
+        self.last_deadline = self._clock()
+        self.last_overshoot = None
+
+    def wait(self, durations, frame: int, wakeup: threading.Event = None) -> int:
+        """
+        Sleeps until the deadline of the frame after `frame` and returns by how many frames the movie has to advance.
+        `durations` are the display durations of all frames in seconds, None when the movie is paused.
+        Returns 1 when on time, more than 1 when frames were skipped and 0 when paused. With a wakeup event, the
+        sleep ends early when it is set, then 0 is returned and the deadline stays the same.
+        """
+        self.last_overshoot = None
+        if durations is None:
+            self._sleep(MIN_FRAME_SECONDS)
+            self.last_deadline = self._clock()
+            return 0
+
+        deadline = self.last_deadline + max(MIN_FRAME_SECONDS, durations[frame])
+        now = self._clock()
+        if now < deadline:
+            if wakeup is not None:
+                if wakeup.wait(deadline - now):
+                    return 0
+            else:
+                self._sleep(deadline - now)
+            self.last_overshoot = self._clock() - deadline
+            self._record(self.last_overshoot)
+            self.last_deadline = deadline
+            return 1
+
+        self.late_frames += 1
+        self._record(now - deadline)
+        if self.policy == POLICY_SKIP:
+            # Skip every frame which would already be over, but at most one loop of the movie
+            step = 1
+            while step < len(durations):
+                next_deadline = deadline + max(MIN_FRAME_SECONDS, durations[(frame + step) % len(durations)])
+                if next_deadline > now:
+                    break
+                deadline = next_deadline
+                step += 1
+            self.dropped_frames += step - 1
+            self.last_deadline = deadline if step < len(durations) else now
+            return step
+
+        # POLICY_REPEAT: the late frame starts a new schedule
+        self.last_deadline = now
+        return 1
+
+    def _record(self, lateness: float):
+        lateness = abs(lateness)
+        self.frames += 1
+        self.jitter_sum += lateness
+        self.jitter_max = max(self.jitter_max, lateness)
+
+    def stats(self) -> dict:
+        return {
+            'policy': self.policy,
+            'frames': self.frames,
+            'dropped_frames': self.dropped_frames,
+            'late_frames': self.late_frames,
+            'jitter_avg_ms': (self.jitter_sum / self.frames * 1000.0) if self.frames > 0 else 0.0,
+            'jitter_max_ms': self.jitter_max * 1000.0,
+        }
@@ -0,0 +1,155 @@
+import asyncio
+import threading
+import time
+
+import numpy as np
+
+import metrics
+
+# Every pushed frame starts with its format byte, followed by
+# - FORMAT_RGB:     width * height * 3 bytes, rows from top to bottom
+# - FORMAT_PALETTE: the number of colors (1 byte, 0 means 256), 3 bytes per color and width * height color indices
+FORMAT_RGB = 0
+FORMAT_PALETTE = 1
+
+# One canvas on the panel, one taken by the render loop until its swap is done, one waiting and one being written
+RING_SIZE = 4
+IDLE_SECONDS = 2.0  # the stream ends when no frame arrived for this long
+
+RECEIVED_FRAMES = metrics.counter('matrix_stream_received_frames_total', 'Frames pushed to the live stream')
+DROPPED_FRAMES = metrics.counter('matrix_stream_dropped_frames_total',
+                                 'Streamed frames replaced by a newer one before they were displayed')
+INVALID_FRAMES = metrics.counter('matrix_stream_invalid_frames_total', 'Streamed frames with a wrong format or size')
+
+
+class FrameStream:
+    """
+    Frames pushed by a remote renderer, shown as they come without a Movie. Every frame is converted straight into
+    one of a few preallocated canvases. The newest frame wins: a frame which was not displayed before the next one
+    arrived is dropped. Pushes come from the event loop of the control server, the render loop takes the frames.
+    """
+
+    def __init__(self, graphics, size: tuple, clock=time.monotonic, wakeup: threading.Event = None):
+        self.graphics = graphics
+        self.size = tuple(size)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._canvass = [graphics.convert_into(None, np.zeros((size[1], size[0], 3), dtype=np.uint8))
+                         for _ in range(RING_SIZE)]
+        self._latest = None  # slot of the newest frame, until the render loop takes it
+        self._taken = None  # slot taken by the render loop, until it confirms the swap with swapped()
+        self._shown = None  # slot on the panel
+        self._last_frame = None  # clock of the last pushed frame
+        self.frame_ready = wakeup or threading.Event()  # set for every new frame
+        self.received = 0
+        self.displayed = 0
+        self.dropped = 0
+        self.invalid = 0
+
+    @property
+    def active(self) -> bool:
+        return self._last_frame is not None and self._clock() - self._last_frame < IDLE_SECONDS
+
+    @property
+    def max_frame_bytes(self) -> int:
+        """Length of the largest valid frame, a palette frame with 256 colors or an RGB frame."""
+        width, height = self.size
+        return max(1 + width * height * 3, 2 + 256 * 3 + width * height)
+
+    def timeout(self) -> float:
+        """Seconds until the stream ends unless another frame arrives."""
+        return max(0.0, self._last_frame + IDLE_SECONDS - self._clock())
+
+    def decode(self, data) -> np.ndarray:
+        """A pushed frame as a (height, width, 3) array, raises ValueError if it does not fit the panel."""
+        width, height = self.size
+        data = memoryview(data)
+        if len(data) == 0:
+            raise ValueError("Empty frame")
+        if data[0] == FORMAT_RGB:
+            if len(data) != 1 + width * height * 3:
+                raise ValueError(f"RGB frames have to be {width}x{height}")
+            return np.frombuffer(data, dtype=np.uint8, offset=1).reshape(height, width, 3)
+        if data[0] == FORMAT_PALETTE and len(data) > 1:
+            colors = data[1] or 256
+            if len(data) != 2 + colors * 3 + width * height:
+                raise ValueError(f"Palette frames have to be {width}x{height} with {colors} colors")
+            palette = np.frombuffer(data, dtype=np.uint8, count=colors * 3, offset=2).reshape(colors, 3)
+            indices = np.frombuffer(data, dtype=np.uint8, offset=2 + colors * 3).reshape(height, width)
+            if int(indices.max()) >= colors:
+                raise ValueError("Color index outside of the palette")
+            return palette[indices]
+        raise ValueError("Unknown frame format")
+
+    def push(self, data) -> bool:
+        """Converts a pushed frame into a free canvas of the ring. False if the frame was invalid."""
+        self.received += 1
+        RECEIVED_FRAMES.inc()
+        try:
+            rgb = self.decode(data)
+        except ValueError:
+            self.invalid += 1
+            INVALID_FRAMES.inc()
+            return False
+
+        with self._lock:
+            busy = (self._latest, self._taken, self._shown)
+            slot = next((i for i in range(RING_SIZE) if i not in busy), None)
+        if slot is None:
+            # Only if frames are pushed from several threads at once, the newest frame wins anyway
+            self.dropped += 1
+            DROPPED_FRAMES.inc()
+            return True
+        # Only the pushing thread writes into a slot which is neither waiting, taken nor shown
+        self._canvass[slot] = self.graphics.convert_into(self._canvass[slot], rgb)
+
+        with self._lock:
+            if self._latest is not None:
+                self.dropped += 1
+                DROPPED_FRAMES.inc()
+            self._latest = slot
+            self._last_frame = self._clock()
+        self.frame_ready.set()
+        return True
+
+    def take(self):
+        """
+        The canvas of the newest frame for the render loop, None if there is no new frame. The canvas on the panel
+        stays reserved until the render loop calls swapped() after the swap.
+        """
+        with self._lock:
+            if self._latest is None:
+                return None
+            if self._taken is not None:
+                self._shown = self._taken  # the last swap was not confirmed, it may be on the panel
+            self._taken = self._latest
+            self._latest = None
+            return self._canvass[self._taken]
+
+    def swapped(self, canvas):
+        """Called by the render loop once the canvas from take() is on the panel, frees the one it replaced."""
+        with self._lock:
+            if self._taken is not None and self._canvass[self._taken] is canvas:
+                self._shown = self._taken
+                self._taken = None
+                self.displayed += 1
+
+    def stats(self) -> dict:
+        return {
+            'active': self.active,
+            'size': list(self.size),
+            'received': self.received,
+            'displayed': self.displayed,
+            'dropped': self.dropped,
+            'invalid': self.invalid,
+        }
+
+
+class UdpFrameProtocol(asyncio.DatagramProtocol):
+    """One frame per datagram, so frames have to fit into 65507 bytes (e.g. 128x64 RGB)."""
+
+    def __init__(self, stream: FrameStream):
+        self.stream = stream
+
+    def datagram_received(self, data: bytes, addr):
+        self.stream.push(data)
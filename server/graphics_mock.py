@@ -1,72 +1,433 @@
 from PIL import Image
+import numpy as np
 import binascii
+import hashlib
 import io
 import json
+import struct
+import animation
+from canvas_pool import CanvasPool
+from panel_config import PanelConfig
+from movie_format import MovieReader, encode_movie
+
+
+# Longest display duration of a single frame, it has to fit into 16 bits in the binary movie format
+MAX_FRAME_DURATION_MS = 0xFFFF
+MAX_FPS = 60
+
+
+class MovieTooLarge(ValueError):
+    pass
+
+
+def check_durations(durations: list, frame_count: int) -> list:
+    """Per-frame display durations in milliseconds, as integers between 1 and MAX_FRAME_DURATION_MS."""
+    if len(durations) != frame_count:
+        raise ValueError(f"Movie has {len(durations)} durations for {frame_count} frames")
+    checked = list()
+    for duration in durations:
+        if isinstance(duration, bool) or not isinstance(duration, (int, float)) \
+                or not 1 <= duration <= MAX_FRAME_DURATION_MS:
+            raise ValueError(f"Frame duration has to be between 1 and {MAX_FRAME_DURATION_MS} ms, not {duration}")
+        checked.append(int(round(duration)))
+    return checked
+
+
+def check_fps(fps) -> int:
+    """The frame rate of a movie, an integer between 0 (paused) and MAX_FPS."""
+    if isinstance(fps, bool) or not isinstance(fps, int) or not 0 <= fps <= MAX_FPS:
+        raise ValueError(f"Movie fps has to be an integer between 0 and {MAX_FPS}, not {fps}")
+    return fps
+
+
+def nominal_fps(durations: list) -> int:
+    """The frame rate of a movie with the same average frame duration, clamped to 1..MAX_FPS."""
+    return max(1, min(MAX_FPS, round(1000.0 * len(durations) / sum(durations)))) if durations else 1
+
+
+def timing_from_wire(data: dict, frame_count: int) -> tuple:
+    """
+    (fps, durations) from the JSON wire format: "fps" and optionally "durations" (milliseconds per frame).
+    Without fps, the nominal frame rate is derived from the durations.
+    """
+    if frame_count == 0:
+        raise ValueError("Movie data has no frames")
+    durations = data.get('durations')
+    if durations is not None:
+        if not isinstance(durations, list):
+            raise ValueError("Movie durations have to be a list")
+        durations = check_durations(durations, frame_count)
+    if 'fps' in data:
+        return check_fps(data['fps']), durations
+    if durations is not None:
+        return nominal_fps(durations), durations
+    raise ValueError("Movie data has neither fps nor durations")
+
+
+# Memory for the canvases of one panel: the movies, the canvas cache and the rings of the compositor and the live
+# stream. The pool holds as many canvases as fit, e.g. about 1500 native canvases of a 64x64 panel.
+DEFAULT_CANVAS_MEMORY = 128 * 1024 * 1024
 
 
 class Movie:
-    def __init__(self, fps: int, frames: list):
+    """
+    Frames shown at `fps`, or for `durations` (milliseconds per frame) if given. With durations, `fps` is the
+    nominal frame rate of the movie and changing the fps of the render loop plays it proportionally faster or slower.
+    """
+
+    def __init__(self, fps: int, frames: list, durations: list = None):
+        if len(frames) == 0:
+            raise ValueError("Movie has no frames")
         self.fps = fps
         self.frames = frames
+        self.durations = check_durations(durations, len(frames)) if durations is not None else None
         self.canvass = None
+        self._digest = None
+        self._frame_arrays = None
+        self.arena = None
+
+    def frame_arrays(self) -> list:
+        """
+        The frames as (height, width, 3) uint8 arrays, created once and kept for re-conversions.
+        Frames which are the same object (see dedupe_frames) share their array. If all frames have the same size,
+        the arrays are read-only views into one FrameArena, and they replace the decoded frames, so the pixels are
+        kept once in a single allocation instead of in an image per frame.
+        """
+        if self._frame_arrays is None:
+            frames = self.shared_frames()  # decoded frames have to stay alive while their ids are compared
+            unique = list({id(frame): frame for frame in frames}.values())
+            base = unique[0].base if isinstance(unique[0], np.ndarray) else None
+            if base is not None and all(isinstance(frame, np.ndarray) and frame.base is base for frame in unique):
+                self._frame_arrays = [frame_to_array(frame) for frame in frames]  # views of the arena of another movie
+            elif len(set(frame_size(frame) for frame in unique)) == 1:
+                self.arena = FrameArena.from_frames(unique)
+                self.arena.array.flags.writeable = False  # shared by the frames, the caches and the compositor
+                slots = {id(frame): i for i, frame in enumerate(unique)}
+                views = [self.arena[i] for i in range(len(unique))]
+                self._frame_arrays = [views[slots[id(frame)]] for frame in frames]
+                if isinstance(self.frames, list):
+                    self.frames = self._frame_arrays  # lazily decoded frames are not kept anyway
+            else:
+                arrays = {id(frame): frame_to_array(frame) for frame in unique}
+                self._frame_arrays = [arrays[id(frame)] for frame in frames]
+        return self._frame_arrays
+
+    def shared_frames(self) -> list:
+        """The frames as a list in which duplicates are the same object, also for lazily decoded frames."""
+        original = getattr(self.frames, 'original', None)
+        if original is None:
+            return list(self.frames)
+        # Lazily decoded frames are new images on every access, every unique frame is decoded once
+        originals = [original(i) for i in range(len(self.frames))]
+        decoded = {i: self.frames[i] for i in sorted(set(originals))}
+        return [decoded[i] for i in originals]
+
+    def frame_seconds(self, fps: int = None) -> tuple:
+        """
+        How long each frame is shown at the given frame rate (the movie's own by default), None when paused.
+        The render loop sleeps once per entry, a frame held for a second is one entry, not 60 copies.
+        """
+        fps = self.fps if fps is None else fps
+        if fps <= 0:
+            return None
+        if self.durations is None:
+            return (1.0 / fps,) * len(self.frames)
+        scale = self.fps / fps if self.fps > 0 else 1.0
+        return tuple(duration / 1000.0 * scale for duration in self.durations)
+
+    def total_seconds(self) -> float:
+        """Length of one loop at the movie's own frame rate."""
+        seconds = self.frame_seconds()
+        return sum(seconds) if seconds is not None else 0.0
+
+    def unique_frames(self) -> int:
+        original = getattr(self.frames, 'original', None)
+        if original is not None:  # lazily decoded frames are new images on every access, see lazy_movie
+            return len(set(original(i) for i in range(len(self.frames))))
+        return len(set(id(frame) for frame in list(self.frames)))
+
+    def digest(self) -> str:
+        """
+        Content hash of the decoded frames and their timing, independent of how the movie was encoded for upload.
+        """
+        if self._digest is None:
+            h = hashlib.sha256()
+            frame_digests = dict()
+            for frame in list(self.frames):
+                if id(frame) not in frame_digests:
+                    frame_digests[id(frame)] = frame_digest(frame)
+                h.update(frame_digests[id(frame)])
+            h.update(json.dumps([self.fps, self.durations]).encode('ascii'))
+            self._digest = h.hexdigest()
+        return self._digest
 
     @staticmethod
-    def load_from_dict(data):
-        fps = data['fps']
+    def decode_frame(b64_image, max_pixels: int = None) -> Image:
+        return Movie.decode_png(binascii.a2b_base64(str(b64_image)), max_pixels)
 
+    @staticmethod
+    def decode_png(png: bytes, max_pixels: int = None) -> Image:
+        with io.BytesIO(png) as f:
+            pil_image = Image.open(f)  # only reads the header
+            if max_pixels is not None and pil_image.width * pil_image.height > max_pixels:
+                raise MovieTooLarge(f"Frame of {pil_image.width}x{pil_image.height} exceeds {max_pixels} pixels")
+
+            # Decode right away, so neither the PNG data nor the file descriptor has to be kept around
+            return pil_image.convert('RGB')
+
+    @staticmethod
+    def load_from_dict(data):
         images = list()
         for b64_image in data['frames']:
-            base64_png = str(b64_image)
-            png = binascii.a2b_base64(base64_png)
+            images.append(Movie.decode_frame(b64_image))
 
-            # Keep the file descriptor open
-            f = io.BytesIO()
-            f.write(png)
-            f.seek(0)
-            pil_image = Image.open(f)
+        fps, durations = timing_from_wire(data, len(images))
+        return Movie(fps, dedupe_frames(images), durations)
 
-            images.append(pil_image)
+    @staticmethod
+    def load_from_animation(data: bytes, max_pixels: int = None, size: tuple = None, parallel: bool = True):
+        """
+        An animated GIF, PNG or WebP (see animation), fit into size if given. Every frame is shown for its own delay.
+        """
+        pil_image = animation.open_animation(data)  # only reads the header
+        if max_pixels is not None and pil_image.width * pil_image.height > max_pixels:
+            raise MovieTooLarge(f"Frame of {pil_image.width}x{pil_image.height} exceeds {max_pixels} pixels")
 
-        return Movie(fps, images)
+        frames, durations = animation.load_animation(data, size, parallel)
+        return Movie(nominal_fps(durations), dedupe_frames(frames), durations)
 
     @staticmethod
     def load_from_json(data):
         return Movie.load_from_dict(json.loads(data))
 
+    @staticmethod
+    def load_from_binary(data):
+        reader = MovieReader(data)
+        return Movie(reader.fps, dedupe_frames([reader.frame(i) for i in range(len(reader))]), reader.durations)
+
     def save_to_dict(self) -> dict:
         images = list()
         for frame in self.frames:
             # base64_png = str(b64_image)
             # png = binascii.a2b_base64(base64_png)
             with io.BytesIO() as f:
-                frame.save(f)
-
-                f.seek(0)
-                b64_image = binascii.b2a_base64(f)
+                frame.save(f, format='PNG')
+                b64_image = binascii.b2a_base64(f.getvalue(), newline=False).decode('ascii')
 
                 images.append(b64_image)
 
-        return {
+        data = {
             'fps': self.fps,
             'frames': images
         }
+        if self.durations is not None:
+            data['durations'] = list(self.durations)
+        return data
 
     def save_to_json(self) -> str:
         return json.dumps(self.save_to_dict())
 
+    def save_to_binary(self) -> bytes:
+        return encode_movie(self.fps, self.frames, durations=self.durations)
+
+
+def frame_digest(frame) -> bytes:
+    """Hash over size and RGB content of a PIL image or RGB array."""
+    rgb = frame_to_array(frame)
+    h = hashlib.blake2b(struct.pack('<HH', rgb.shape[1], rgb.shape[0]), digest_size=20)
+    h.update(np.ascontiguousarray(rgb).data)
+    return h.digest()
+
+
+def dedupe_frames(frames: list) -> list:
+    """
+    Replaces frames with the same content by the first of them, so duplicates share one object
+    (and later one array and one canvas). Animations often repeat frames to hold them longer.
+    """
+    seen = dict()
+    return [seen.setdefault(frame_digest(frame), frame) for frame in frames]
+
+
+def frame_size(frame) -> tuple:
+    """(width, height) of a PIL image or RGB array."""
+    if isinstance(frame, np.ndarray):
+        return frame.shape[1], frame.shape[0]
+    return frame.size
+
+
+class FrameArena:
+    """
+    Frames of the same size in one contiguous (count, height, width, 3) uint8 array. Frames are views into it,
+    so there is one allocation for all frames.
+    """
+
+    def __init__(self, count: int, width: int, height: int):
+        self.array = np.empty((count, height, width, 3), dtype=np.uint8)
+
+    @staticmethod
+    def from_frames(frames: list):
+        width, height = frame_size(frames[0])
+        arena = FrameArena(len(frames), width, height)
+        for i, frame in enumerate(frames):
+            arena.array[i] = frame_to_array(frame)
+        return arena
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        return self.array[i]
+
+    @property
+    def nbytes(self) -> int:
+        return self.array.nbytes
+
+
+def array_to_image(rgb: np.ndarray) -> Image:
+    """
+    A PIL image of a contiguous (height, width, 3) uint8 array. Pillow stores RGB with 4 bytes per pixel, so the
+    pixels are copied once (it can only map buffers of 1 and 4 byte modes).
+    """
+    return Image.frombuffer('RGB', (rgb.shape[1], rgb.shape[0]), memoryview(rgb), 'raw', 'RGB', 0, 1)
+
+
+def validate_canvas_frame(rgb, size: tuple) -> np.ndarray:
+    """
+    The last stage before a frame is written into a canvas: returns it as a C-contiguous (height, width, 3) uint8
+    array of exactly the canvas size (width, height), raises ValueError for anything else. Frames are never
+    cropped or padded here, that is the job of PanelConfig.remap.
+    """
+    width, height = size
+    if not isinstance(rgb, np.ndarray) or rgb.dtype != np.uint8 or rgb.shape != (height, width, 3):
+        shape = rgb.shape if isinstance(rgb, np.ndarray) else type(rgb).__name__
+        raise ValueError(f"Canvas frames have to be ({height}, {width}, 3) uint8 arrays, not {shape}")
+    return np.ascontiguousarray(rgb)
+
+
+def canvas_image(rgb, size: tuple) -> Image:
+    """
+    A validated frame (see validate_canvas_frame) as an RGB image of exactly the canvas size, which owns its pixels.
+    Such images are safe for the unsafe SetImage, which reads the rows of the image without any checks.
+    """
+    image = Image.frombytes('RGB', tuple(size), validate_canvas_frame(rgb, size))
+    image.load()
+    return image
+
+
+def frame_to_array(frame) -> np.ndarray:
+    if isinstance(frame, np.ndarray):
+        if frame.dtype != np.uint8 or frame.ndim != 3 or frame.shape[2] != 3 or frame.size == 0:
+            raise ValueError(f"Frames have to be (height, width, 3) uint8 arrays, not {frame.dtype} {frame.shape}")
+        return frame
+    if frame.width == 0 or frame.height == 0:
+        raise ValueError("Frames must not be empty")
+    return np.asarray(frame if frame.mode == 'RGB' else frame.convert('RGB'))
+
+
+class ColorAdjustment:
+    """Brightness (0-100) and gamma as a lookup table over the 8 bit color values, applied to a frame at once."""
+
+    def __init__(self, brightness: int, gamma: float = 1.0):
+        self.brightness = brightness
+        self.gamma = gamma
+        values = np.power(np.arange(256, dtype=np.float64) / 255.0, gamma)
+        self.lut = np.round(values * 255.0 * brightness / 100.0).astype(np.uint8)
+
+    def apply(self, rgb: np.ndarray) -> np.ndarray:
+        return self.lut[rgb]
+
 
 class Graphics:
-    def __init__(self, brightness: int):
-        pass
+    def __init__(self, brightness: int, gamma: float = 1.0, panel: PanelConfig = None,
+                 canvas_memory: int = DEFAULT_CANVAS_MEMORY):
+        self.adjustment = ColorAdjustment(brightness, gamma)
+        self.panel = panel  # without a panel config, frames are shown in their own size
+        # Canvases of the panel size come from a pool, without a panel (any size) every canvas is new
+        self.pool = CanvasPool(max(1, canvas_memory // self.canvas_bytes()), self._new_canvas) \
+            if panel is not None else None
+        self._on_panel = None  # the displayed canvas must not go back to the pool before the next one is shown
+
+    @property
+    def size(self) -> tuple:
+        """(width, height) frames should have to be shown without scaling, None if any size is fine."""
+        return self.panel.content_size if self.panel is not None else None
+
+    @property
+    def brightness(self) -> int:
+        return self.adjustment.brightness
+
+    def cache_key(self, adjustment: ColorAdjustment = None) -> tuple:
+        """Everything besides the frames that influences the outcome of convert_to_canvas."""
+        adjustment = adjustment or self.adjustment
+        key = type(self).__name__, adjustment.brightness, adjustment.gamma
+        return key + self.panel.key() if self.panel is not None else key
 
-    def convert_to_canvas(self, frames: list) -> list:
-        return frames
+    def canvas_bytes(self, size: tuple = None) -> int:
+        """Estimated memory of one canvas, for frames of the given (width, height) if there is no panel."""
+        if self.panel is None:
+            # A PIL image of the frame size, Pillow keeps RGB with 4 bytes per pixel
+            return size[0] * size[1] * 4 if size is not None else 0
+        width, height = self.panel.size
+        return width * height * 3
+
+    def convert_to_canvas(self, frames: list, adjustment: ColorAdjustment = None) -> list:
+        """
+        Converts PIL images or RGB arrays to canvases. Frames are mapped onto the panel (see PanelConfig.remap) and
+        brightness and gamma are applied with a lookup table. The adjustment is captured once so a concurrent
+        brightness change can't produce a mixed result.
+        """
+        adjustment = adjustment or self.adjustment
+        unique = list({id(frame): frame for frame in frames}.values())  # the same object shares its canvas
+        sizes = set(frame_size(frame) for frame in unique)
+        size = self.panel.size if self.panel is not None else (sizes.pop() if len(sizes) == 1 else None)
+        if size is not None:
+            # The adjusted frames of one conversion are written into one arena, instead of an array per frame
+            adjusted = FrameArena(len(unique), *size)
+            converted = dict()
+            for i, frame in enumerate(unique):
+                rgb = frame_to_array(frame)
+                if self.panel is not None:
+                    rgb = self.panel.remap(rgb)
+                np.take(adjustment.lut, rgb, out=adjusted[i])
+                converted[id(frame)] = self._create_canvas(adjusted[i])
+        else:
+            converted = {id(frame): self._create_canvas(adjustment.apply(frame_to_array(frame))) for frame in unique}
+
+        return [converted[id(frame)] for frame in frames]
+
+    def convert_into(self, canvas, frame, adjustment: ColorAdjustment = None):
+        """
+        Like convert_to_canvas for a single frame, but the pixels are written into an existing canvas (None creates
+        one). For frames which change all the time, like the composed frame of the Compositor. Returns the canvas.
+        """
+        rgb = frame_to_array(frame)
+        if self.panel is not None:
+            rgb = self.panel.remap(rgb)
+        return self._fill_canvas(canvas, (adjustment or self.adjustment).apply(rgb))
+
+    def _create_canvas(self, rgb: np.ndarray):
+        return self._fill_canvas(None, rgb)
+
+    def _new_canvas(self):
+        """A native canvas for the pool, the mock simulates one with an array of the panel size."""
+        width, height = self.panel.size
+        return np.zeros((height, width, 3), dtype=np.uint8)
+
+    def _fill_canvas(self, canvas, rgb: np.ndarray):
+        if self.pool is None:
+            # Without a panel the canvas is a PIL image, a copy of the adjusted frame
+            return array_to_image(rgb)
+        rgb = validate_canvas_frame(rgb, self.panel.size)  # the same checks as for the native canvases
+        if canvas is None:
+            canvas = self.pool.acquire()
+        canvas.native[:] = rgb  # like SetImage, which copies the pixels into the native canvas
+        return canvas
 
     def set_brightness(self, brightness: int):
-        pass
+        self.adjustment = ColorAdjustment(brightness, self.adjustment.gamma)
 
     def display_canvas(self, canvas):
-        pass
+        self._on_panel = canvas
 
     def clear(self):
         pass
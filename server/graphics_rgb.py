@@ -1,45 +1,61 @@
+import os
+
 from rgbmatrix import graphics, RGBMatrix, RGBMatrixOptions
+import numpy as np
 from PIL import Image
-import binascii
-import io
-from graphics_mock import Movie, Graphics as GraphicsMock
+from graphics_mock import DEFAULT_CANVAS_MEMORY, Graphics as GraphicsMock, canvas_image
+from panel_config import PanelConfig
+
+
+def unsafe_set_image_supported() -> bool:
+    """The unsafe SetImage reads the pixels through the row pointers of Pillow, which newer Pillows don't expose."""
+    try:
+        return dict(Image.new('RGB', (1, 1)).im.unsafe_ptrs).get('image32', 0) != 0
+    except AttributeError:
+        return False
 
 
 class Graphics(GraphicsMock):
-    def __init__(self, brightness: int):
-        self.brightness = max(1, min(100, brightness))
+    def __init__(self, brightness: int, gamma: float = 1.0, panel: PanelConfig = None,
+                 canvas_memory: int = DEFAULT_CANVAS_MEMORY):
+        super().__init__(max(1, min(100, brightness)), gamma, panel or PanelConfig(), canvas_memory)
         self._do_init()
 
     def _do_init(self):
         options = RGBMatrixOptions()
-        options.rows = 32
-        options.cols = 64
-        options.chain_length = 2
-        options.pixel_mapper_config = "U-mapper"
-        options.hardware_mapping = "adafruit-hat"
-        options.gpio_slowdown = 4
-        options.brightness = self.brightness
+        self.panel.apply(options)
+        options.brightness = 100  # brightness is applied to the frames by ColorAdjustment
+        self.options = options
         self.matrix = RGBMatrix(options=options)
+        if (self.matrix.width, self.matrix.height) != self.panel.size:
+            raise ValueError(f"Panel is {self.matrix.width}x{self.matrix.height}, the panel config expects "
+                             f"{self.panel.size[0]}x{self.panel.size[1]}")
+
+        # Every frame passes canvas_image, so the unsafe SetImage only ever sees RGB images of the canvas size which
+        # own their pixels. MATRIX_SAFE_SET_IMAGE=1 forces the slow path anyway.
+        self.unsafe_set_image = os.environ.get('MATRIX_SAFE_SET_IMAGE') != '1' and unsafe_set_image_supported()
+        print(f"Using the {'unsafe' if self.unsafe_set_image else 'safe'} SetImage")
 
-    def convert_to_canvas(self, frames: list) -> list:
-        canvass = list()
-        for image in frames:
-            with io.BytesIO() as f:
-                canvas = self.matrix.CreateFrameCanvas()
-                pil_image = image.convert('RGB')
-                canvas.SetImage(pil_image, unsafe=False)  # Unsafe is faster, but sometimes has segmentation faults
+    def canvas_bytes(self, size: tuple = None) -> int:
+        # The native frame buffer holds 11 pwm bit planes of one 32 bit word per pixel of a double row. The panel
+        # config gives the size before the matrix exists, _do_init checks that they agree.
+        width, height = self.panel.size
+        return width * height // 2 * 11 * 4
 
-                canvass.append(canvas)
+    def _new_canvas(self):
+        return self.matrix.CreateFrameCanvas()  # never freed by rgbmatrix, only called by the pool
 
-        return canvass
+    def _fill_canvas(self, canvas, rgb: np.ndarray):
+        if canvas is None:
+            canvas = self.pool.acquire()
+        # SetImage copies the pixels into the native canvas
+        canvas.native.SetImage(canvas_image(rgb, self.panel.size), unsafe=self.unsafe_set_image)
 
-    def set_brightness(self, brightness: int):
-        self.brightness = brightness
-        self.matrix.brightness = brightness  # needs reloading of the movie to work
-        # causes segmentation fault self._do_init()
+        return canvas
 
     def display_canvas(self, canvas):
-        self.matrix.SwapOnVSync(canvas)
+        self.matrix.SwapOnVSync(canvas.native)
+        self._on_panel = canvas
 
     def clear(self):
         self.matrix.Clear()
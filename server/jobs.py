@@ -0,0 +1,110 @@
+import itertools
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+class TooManyJobs(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, serial: int):
+        self.id = uuid.uuid4().hex
+        self.serial = serial  # submission order
+        self.status = STATUS_QUEUED
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.finished = None
+        self._done = threading.Event()
+
+    @property
+    def is_finished(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._done.wait(timeout)
+
+    def _finish(self, status: str, result=None, error: str = None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.finished = time.time()
+        self._done.set()
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'submitted': self.submitted,
+            'finished': self.finished,
+        }
+
+
+class JobManager:
+    """
+    Runs jobs on a small thread pool, so request threads can answer right away. At most `max_pending` jobs may be
+    queued or running, the last `keep_finished` finished jobs can still be queried.
+    """
+
+    def __init__(self, max_workers: int = 2, max_pending: int = 4, keep_finished: int = 64):
+        self.max_pending = max_pending
+        self.keep_finished = keep_finished
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._serials = itertools.count(1)
+        self._jobs = OrderedDict()
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args) -> Job:
+        """fn(job, *args) runs on the pool, its return value becomes the job result."""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise TooManyJobs(f"{self._pending} jobs are still pending")
+            self._pending += 1
+            job = Job(next(self._serials))
+            self._jobs[job.id] = job
+            self._prune()
+
+        self._executor.submit(self._run, job, fn, args)
+        return job
+
+    def _run(self, job: Job, fn, args):
+        job.status = STATUS_RUNNING
+        try:
+            job._finish(STATUS_DONE, result=fn(job, *args))
+        except Exception as e:
+            print(f"Job {job.id} failed: ")
+            print(traceback.format_exc())
+            job._finish(STATUS_FAILED, error=str(e))
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.is_finished]
+        for job_id in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> Job:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'pending': self._pending,
+                'max_pending': self.max_pending,
+                'known': len(self._jobs),
+            }
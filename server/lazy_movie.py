@@ -0,0 +1,93 @@
+import mmap
+import threading
+
+from graphics_mock import Movie
+from movie_format import MAX_REFERENCE_DEPTH, MovieFormatError, MovieReader
+
+
+class LazyFrames:
+    """Sequence of PIL images, decoded from the binary movie every time they are accessed."""
+
+    def __init__(self, reader: MovieReader):
+        self.reader = reader
+
+    def __len__(self):
+        return len(self.reader)
+
+    def __getitem__(self, i: int):
+        if i < 0:
+            i += len(self.reader)
+        return self.reader.frame(i)
+
+    def original(self, i: int) -> int:
+        """Index of the first frame with the content of frame i, following duplicates of duplicates."""
+        for _ in range(MAX_REFERENCE_DEPTH + 1):
+            duplicate_of = self.reader.duplicate_of(i)
+            if duplicate_of is None:
+                return i
+            i = duplicate_of
+        raise MovieFormatError(f"Frame {i} references too many other frames")
+
+
+class LazyCanvasList:
+    """
+    Sequence of canvases which are converted on first access. A background thread can prefetch them in order,
+    the render loop converts a frame itself if it gets there first. Duplicate frames share the canvas of the
+    frame they repeat.
+    """
+
+    def __init__(self, frames: LazyFrames, graphics):
+        self.frames = frames
+        self.graphics = graphics
+        self.adjustment = graphics.adjustment  # brightness at the time of creation, for all frames
+        self._canvass = [None] * len(frames)
+        self._lock = threading.Lock()
+        self._cancelled = False
+
+    def __len__(self):
+        return len(self._canvass)
+
+    def __getitem__(self, i: int):
+        canvas = self._canvass[i]
+        if canvas is None:
+            original = self.frames.original(i)
+            if original != i:
+                canvas = self[original]
+                self._canvass[i] = canvas
+                return canvas
+            with self._lock:
+                canvas = self._canvass[i]
+                if canvas is None:
+                    canvas = self.graphics.convert_to_canvas([self.frames[i]], self.adjustment)[0]
+                    self._canvass[i] = canvas
+        return canvas
+
+    def prefetch(self):
+        for i in range(len(self._canvass)):
+            if self._cancelled:
+                return
+            self[i]
+
+    def start_prefetch(self) -> threading.Thread:
+        thread = threading.Thread(target=self.prefetch, daemon=True)
+        thread.start()
+        return thread
+
+    def cancel_prefetch(self):
+        self._cancelled = True
+
+
+def map_movie(file_name: str, graphics=None) -> Movie:
+    """
+    Memory maps a binary movie file, nothing is decoded up front. The mapping stays valid when the file
+    is replaced (see movie_format.write_atomic), it is released together with the movie.
+    """
+    with open(file_name, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    reader = MovieReader(data)
+    frames = LazyFrames(reader)
+    movie = Movie(reader.fps, frames, reader.durations)
+    if graphics is not None:
+        movie.canvass = LazyCanvasList(frames, graphics)
+    return movie
@@ -0,0 +1,176 @@
+import bisect
+import collections
+import threading
+import time
+
+# Metrics in the Prometheus text exposition format (version 0.0.4), without depending on a client library.
+# Modules create their metrics at import time with counter(), gauge() and histogram() on the default REGISTRY.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Bucket upper bounds
+SECONDS_FAST = (0.0005, 0.001, 0.002, 0.004, 0.008, 0.016, 0.033, 0.066, 0.1, 0.25, 0.5, 1.0)
+SECONDS_SLOW = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BYTES = (16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024)
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self) -> list:
+        return [(self.name, '', self.value)]
+
+
+class Gauge:
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, function=None):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+        self._function = function  # evaluated on every scrape, if given
+
+    def set(self, value: float):
+        self.value = value
+
+    def samples(self) -> list:
+        return [(self.name, '', self._function() if self._function is not None else self.value)]
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: tuple):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """Context manager observing the duration of the block in seconds."""
+        return _Timer(self)
+
+    def samples(self) -> list:
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+
+        samples = list()
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            samples.append((self.name + '_bucket', f'{{le="{_format_value(bound)}"}}', cumulative))
+        samples.append((self.name + '_sum', '', total))
+        samples.append((self.name + '_count', '', count))
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.monotonic() - self.start)
+
+
+class RateMeter:
+    """Events per second over a rolling time window, e.g. the achieved fps of the last seconds."""
+
+    def __init__(self, window: float = 2.0, clock=time.monotonic):
+        self.window = window
+        self._clock = clock
+        self._events = collections.deque()
+        self._lock = threading.Lock()
+
+    def mark(self):
+        now = self._clock()
+        with self._lock:
+            self._events.append(now)
+            self._expire(now)
+
+    def reset(self):
+        with self._lock:
+            self._events.clear()
+
+    def _expire(self, now: float):
+        while self._events and self._events[0] < now - self.window:
+            self._events.popleft()
+
+    def rate(self) -> float:
+        """-1 while there are not enough events in the window to tell."""
+        with self._lock:
+            self._expire(self._clock())
+            if len(self._events) < 2 or self._events[-1] <= self._events[0]:
+                return -1
+            return (len(self._events) - 1) / (self._events[-1] - self._events[0])
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = list()
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str) -> Counter:
+    return REGISTRY.register(Counter(name, documentation))
+
+
+def gauge(name: str, documentation: str, function=None) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, function))
+
+
+def histogram(name: str, documentation: str, buckets: tuple) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, buckets))
@@ -0,0 +1,356 @@
+import os
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+from PIL import Image
+
+# Binary movie container, all numbers little endian
+#
+# header        see HEADER
+# palette       palette_size * 3 bytes (r, g, b), only for the palette pixel formats
+# frame index   frame_count * INDEX_ENTRY (offset from the start of the file, stored length, flags)
+# durations     frame_count * DURATION, display duration of every frame in milliseconds, 0 for 1 / fps
+#               (since version 3)
+# frame data    width * height pixels per frame, 1 byte (PAL8), 2 bytes (PAL16) or 3 bytes (RGB24) each,
+#               row by row, optionally zlib compressed per frame
+#
+# Since version 2 a frame may also be
+# - a duplicate (FLAG_DUPLICATE): the offset is the index of an earlier frame with the same content, no data
+# - a delta (FLAG_DELTA): only the rectangles which changed since the previous frame, see DELTA_COUNT and
+#   DELTA_RECT, followed by the pixels of every rectangle row by row in the pixel format of the movie.
+#   Every KEYFRAME_INTERVAL frames there is a full frame, so random access decodes a bounded number of deltas.
+
+CONTENT_TYPE = 'application/x-matrix-movie'
+MAGIC = b'MXMV'
+VERSION = 3
+SUPPORTED_VERSIONS = (1, 2, 3)
+
+# magic, version, width, height, frame count, fps, pixel format, compression, palette size
+HEADER = struct.Struct('<4sHHHIHBBI')
+INDEX_ENTRY = struct.Struct('<QII')
+DURATION = struct.Struct('<H')
+# rectangle count, then per rectangle x, y, width, height
+DELTA_COUNT = struct.Struct('<H')
+DELTA_RECT = struct.Struct('<HHHH')
+
+FORMAT_RGB24 = 0
+FORMAT_PAL8 = 1
+FORMAT_PAL16 = 2
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+
+FLAG_ZLIB = 1
+FLAG_DUPLICATE = 2
+FLAG_DELTA = 4
+
+KEYFRAME_INTERVAL = 32
+TILE_SIZE = 8  # granularity of the dirty rectangles
+MAX_REFERENCE_DEPTH = 256  # duplicates and deltas referencing each other, more means a corrupt file
+
+
+class MovieFormatError(ValueError):
+    pass
+
+
+def is_binary_movie(data) -> bool:
+    return bytes(data[:len(MAGIC)]) == MAGIC
+
+
+def write_atomic(file_name: str, data: bytes):
+    """
+    Writes to a temporary file and renames it, so readers (and memory maps) either see the old or the new file,
+    never a partially written one.
+    """
+    # A temporary file of its own for every writer, concurrent writes of the same file must not share one
+    fd, temp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_name)),
+                                     prefix=os.path.basename(file_name) + '.', suffix='.tmp')
+    try:
+        with open(fd, 'wb') as f:
+            os.fchmod(f.fileno(), 0o644)  # mkstemp creates the file only readable for its owner
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_name, file_name)
+    except BaseException:
+        try:
+            os.unlink(temp_name)
+        except OSError:
+            pass
+        raise
+
+    # Persist the rename itself, otherwise a power loss can still bring back the old directory entry
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(os.path.dirname(os.path.abspath(file_name)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _pack_rgb(rgb: np.ndarray) -> np.ndarray:
+    rgb = rgb.astype(np.uint32)
+    return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+
+def _unpack_rgb(packed: np.ndarray) -> np.ndarray:
+    return np.stack([(packed >> 16) & 0xFF, (packed >> 8) & 0xFF, packed & 0xFF], axis=-1).astype(np.uint8)
+
+
+def dirty_rects(pixels: np.ndarray, previous: np.ndarray) -> list:
+    """
+    Rectangles (x, y, width, height) covering all pixels which differ between two frames. The frames are compared
+    in tiles of TILE_SIZE, neighbouring dirty tiles in a tile row are merged into one rectangle.
+    """
+    changed = pixels != previous
+    if changed.ndim == 3:
+        changed = changed.any(axis=2)
+
+    height, width = changed.shape
+    rows, cols = -(-height // TILE_SIZE), -(-width // TILE_SIZE)
+    padded = np.zeros((rows * TILE_SIZE, cols * TILE_SIZE), dtype=bool)
+    padded[:height, :width] = changed
+    tiles = padded.reshape(rows, TILE_SIZE, cols, TILE_SIZE).any(axis=(1, 3))
+
+    rects = list()
+    for row in np.flatnonzero(tiles.any(axis=1)):
+        dirty = np.flatnonzero(tiles[row])
+        runs = np.split(dirty, np.flatnonzero(np.diff(dirty) != 1) + 1)
+        y = int(row) * TILE_SIZE
+        for run in runs:
+            x = int(run[0]) * TILE_SIZE
+            rects.append((x, y, min((int(run[-1]) + 1) * TILE_SIZE, width) - x, min(TILE_SIZE, height - y)))
+    return rects
+
+
+def _encode_delta(pixels: np.ndarray, previous: np.ndarray) -> bytes:
+    """None if there are too many rectangles to count."""
+    rects = dirty_rects(pixels, previous)
+    if len(rects) > 0xFFFF:
+        return None
+    parts = [DELTA_COUNT.pack(len(rects))]
+    parts.extend(DELTA_RECT.pack(*rect) for rect in rects)
+    parts.extend(pixels[y:y + h, x:x + w].tobytes() for x, y, w, h in rects)
+    return b''.join(parts)
+
+
+def _compress(raw: bytes, compression: int, flags: int) -> tuple:
+    if compression == COMPRESSION_ZLIB:
+        compressed = zlib.compress(raw)
+        if len(compressed) < len(raw):
+            return compressed, flags | FLAG_ZLIB
+    return raw, flags
+
+
+def encode_movie(fps: int, frames: list, compression: int = COMPRESSION_ZLIB, durations: list = None) -> bytes:
+    """
+    Encodes a list of PIL images or (height, width, 3) uint8 arrays of the same size, with optional display
+    durations in milliseconds per frame. Repeated frames are stored once, frames between key frames are stored as
+    the rectangles which changed since the previous frame, if that is smaller.
+    """
+    if len(frames) == 0:
+        raise MovieFormatError("Movie has no frames")
+
+    rgbs = [np.asarray(frame.convert('RGB')) if isinstance(frame, Image.Image) else frame for frame in frames]
+    height, width = rgbs[0].shape[:2]
+    packed_frames = list()
+    for rgb in rgbs:
+        if rgb.dtype != np.uint8 or rgb.shape != (height, width, 3):
+            raise MovieFormatError(f"Frame of {rgb.dtype} {rgb.shape} differs from ({height}, {width}, 3) uint8")
+        packed_frames.append(_pack_rgb(rgb))
+
+    palette = np.unique(np.concatenate([p.ravel() for p in packed_frames]))
+    if len(palette) <= 0x100:
+        pixel_format, index_type = FORMAT_PAL8, np.uint8
+    elif len(palette) <= 0x10000:
+        pixel_format, index_type = FORMAT_PAL16, np.dtype('<u2')
+    else:
+        pixel_format, index_type, palette = FORMAT_RGB24, None, palette[:0]
+
+    if durations is not None and len(durations) != len(frames):
+        raise MovieFormatError(f"Movie has {len(durations)} durations for {len(frames)} frames")
+    durations_bytes = np.array(durations if durations is not None else [0] * len(frames), dtype='<u2').tobytes()
+
+    palette_bytes = _unpack_rgb(palette).tobytes()
+    data_offset = HEADER.size + len(palette_bytes) + (INDEX_ENTRY.size + DURATION.size) * len(frames)
+
+    index = list()
+    chunks = list()
+    offset = data_offset
+    seen = dict()  # frame content -> index of the first frame with it
+    previous = None
+    for i, packed in enumerate(packed_frames):
+        if index_type is None:
+            pixels = _unpack_rgb(packed)
+        else:
+            pixels = np.searchsorted(palette, packed).astype(index_type)
+
+        full = pixels.tobytes()
+        first = seen.setdefault(full, i)
+        if first != i:
+            index.append(INDEX_ENTRY.pack(first, 0, FLAG_DUPLICATE))
+            previous = pixels
+            continue
+
+        raw, flags = _compress(full, compression, 0)
+        if previous is not None and i % KEYFRAME_INTERVAL != 0:
+            delta = _encode_delta(pixels, previous)
+            if delta is not None:
+                delta, delta_flags = _compress(delta, compression, FLAG_DELTA)
+                if len(delta) < len(raw):
+                    raw, flags = delta, delta_flags
+
+        index.append(INDEX_ENTRY.pack(offset, len(raw), flags))
+        chunks.append(raw)
+        offset += len(raw)
+        previous = pixels
+
+    header = HEADER.pack(MAGIC, VERSION, width, height, len(frames), fps, pixel_format, compression, len(palette))
+    return b''.join([header, palette_bytes] + index + [durations_bytes] + chunks)
+
+
+class MovieReader:
+    """
+    Random access to the frames of a binary movie. The data can be anything supporting the buffer protocol
+    (bytes, memoryview, mmap), frames are only decoded on request. The last decoded frame is kept, so sequential
+    access decodes every delta frame only once.
+    """
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        if len(self.data) < HEADER.size or not is_binary_movie(self.data):
+            raise MovieFormatError("Not a binary movie")
+
+        magic, version, self.width, self.height, self.frame_count, self.fps, self.pixel_format, self.compression, \
+            palette_size = HEADER.unpack_from(self.data, 0)
+        if version not in SUPPORTED_VERSIONS:
+            raise MovieFormatError(f"Unsupported movie version {version}")
+        if self.pixel_format not in (FORMAT_RGB24, FORMAT_PAL8, FORMAT_PAL16):
+            raise MovieFormatError(f"Unknown pixel format {self.pixel_format}")
+        if self.frame_count == 0:
+            raise MovieFormatError("Movie has no frames")
+
+        palette_end = HEADER.size + palette_size * 3
+        self.index_offset = palette_end
+        durations_offset = palette_end + self.frame_count * INDEX_ENTRY.size
+        durations_end = durations_offset + (self.frame_count * DURATION.size if version >= 3 else 0)
+        if len(self.data) < durations_end:
+            raise MovieFormatError("Truncated movie header")
+
+        self.palette = np.frombuffer(self.data[HEADER.size:palette_end], dtype=np.uint8).reshape(-1, 3)
+
+        # Milliseconds per frame, None if all frames are shown for 1 / fps
+        self.durations = None
+        if version >= 3:
+            durations = np.frombuffer(self.data[durations_offset:durations_end], dtype='<u2')
+            if durations.any():
+                default = max(1, round(1000.0 / self.fps)) if self.fps > 0 else 100
+                self.durations = [int(duration) or default for duration in durations]
+        self._last = (None, None)  # (frame index, pixels), replaced as a whole so threads may share the reader
+
+    def __len__(self):
+        return self.frame_count
+
+    def _shape(self) -> tuple:
+        if self.pixel_format == FORMAT_RGB24:
+            return np.uint8, 3
+        return (np.uint8 if self.pixel_format == FORMAT_PAL8 else np.dtype('<u2')), 1
+
+    def _item_size(self) -> int:
+        dtype, channels = self._shape()
+        return np.dtype(dtype).itemsize * channels
+
+    def _payload(self, i: int, offset: int, length: int, flags: int) -> bytes:
+        if offset + length > len(self.data):
+            raise MovieFormatError(f"Frame {i} exceeds the movie data")
+
+        raw = self.data[offset:offset + length]
+        if flags & FLAG_ZLIB:
+            # Never inflate more than a valid payload can have, a small file could expand to gigabytes
+            max_size = self.width * self.height * self._item_size()
+            if flags & FLAG_DELTA:
+                max_size += DELTA_COUNT.size + 0xFFFF * DELTA_RECT.size
+            try:
+                inflater = zlib.decompressobj()
+                raw = inflater.decompress(raw, max_size + 1)
+            except zlib.error as e:
+                raise MovieFormatError(f"Frame {i} is corrupt: {e}")
+            if len(raw) > max_size or inflater.unconsumed_tail:
+                raise MovieFormatError(f"Frame {i} inflates to more than {max_size} bytes")
+        return raw
+
+    def _to_pixels(self, i: int, raw, width: int, height: int) -> np.ndarray:
+        dtype, channels = self._shape()
+        expected = width * height * channels * np.dtype(dtype).itemsize
+        if len(raw) != expected:
+            raise MovieFormatError(f"Frame {i} has {len(raw)} bytes, expected {expected}")
+
+        pixels = np.frombuffer(raw, dtype=dtype)
+        if channels == 1 and pixels.max(initial=0) >= len(self.palette):
+            raise MovieFormatError(f"Frame {i} references colors outside of the palette")
+        return pixels.reshape((height, width, 3) if channels == 3 else (height, width))
+
+    def _apply_delta(self, i: int, raw, previous: np.ndarray) -> np.ndarray:
+        if len(raw) < DELTA_COUNT.size:
+            raise MovieFormatError(f"Frame {i} has a truncated delta")
+        count, = DELTA_COUNT.unpack_from(raw, 0)
+        data_offset = DELTA_COUNT.size + count * DELTA_RECT.size
+        if len(raw) < data_offset:
+            raise MovieFormatError(f"Frame {i} has a truncated delta")
+
+        item_size = self._item_size()
+        pixels = previous.copy()
+        for r in range(count):
+            x, y, w, h = DELTA_RECT.unpack_from(raw, DELTA_COUNT.size + r * DELTA_RECT.size)
+            if x + w > self.width or y + h > self.height:
+                raise MovieFormatError(f"Frame {i} has a delta outside of the frame")
+            size = w * h * item_size
+            pixels[y:y + h, x:x + w] = self._to_pixels(i, raw[data_offset:data_offset + size], w, h)
+            data_offset += size
+        if data_offset != len(raw):
+            raise MovieFormatError(f"Frame {i} has {len(raw) - data_offset} bytes after its delta")
+        return pixels
+
+    def _pixels(self, i: int, depth: int = 0) -> np.ndarray:
+        """Palette indices or RGB values of frame i, the returned array must not be modified."""
+        if not 0 <= i < self.frame_count:
+            raise IndexError(i)
+        if depth > MAX_REFERENCE_DEPTH:
+            raise MovieFormatError(f"Frame {i} references too many other frames")
+
+        last_index, last_pixels = self._last
+        if last_index == i:
+            return last_pixels
+
+        offset, length, flags = INDEX_ENTRY.unpack_from(self.data, self.index_offset + i * INDEX_ENTRY.size)
+        if flags & FLAG_DUPLICATE:
+            if offset >= i:
+                raise MovieFormatError(f"Frame {i} duplicates a later frame")
+            pixels = self._pixels(offset, depth + 1)
+        elif flags & FLAG_DELTA:
+            if i == 0:
+                raise MovieFormatError("The first frame can not be a delta")
+            previous = self._pixels(i - 1, depth + 1)
+            pixels = self._apply_delta(i, self._payload(i, offset, length, flags), previous)
+        else:
+            pixels = self._to_pixels(i, self._payload(i, offset, length, flags), self.width, self.height)
+
+        self._last = (i, pixels)
+        return pixels
+
+    def duplicate_of(self, i: int) -> int:
+        """Index of the earlier frame frame i repeats, or None."""
+        offset, _, flags = INDEX_ENTRY.unpack_from(self.data, self.index_offset + i * INDEX_ENTRY.size)
+        return offset if flags & FLAG_DUPLICATE and offset < i else None
+
+    def frame_bytes(self, i: int) -> bytes:
+        """Returns the raw RGB bytes (width * height * 3) of frame i."""
+        pixels = self._pixels(i)
+        if self.pixel_format == FORMAT_RGB24:
+            return pixels.tobytes()
+        return self.palette[pixels].tobytes()
+
+    def frame(self, i: int) -> Image:
+        return Image.frombytes('RGB', (self.width, self.height), self.frame_bytes(i))
@@ -0,0 +1,127 @@
+import json
+import os
+import re
+import threading
+
+import movie_format
+from graphics_mock import Movie
+from lazy_movie import map_movie
+
+DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+NAME_PATTERN = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+NAMES_FILE = 'names.json'
+
+
+class MovieStore:
+    """
+    Library of movies on disk, content addressed by Movie.digest(). Every movie is one binary movie file
+    (<digest>.movie), so showing a stored movie maps it instead of decoding PNGs. Movies can also be referenced
+    by names, which are kept in names.json. All files are replaced atomically, a power loss leaves either the
+    old or the new version.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        for file_name in os.listdir(root):
+            if file_name.endswith('.tmp'):
+                os.remove(os.path.join(root, file_name))  # left over from an interrupted write
+        self._names = self._load_names()
+
+    def _load_names(self) -> dict:
+        try:
+            with open(os.path.join(self.root, NAMES_FILE), 'r') as f:
+                names = json.load(f)
+        except FileNotFoundError:
+            return dict()
+        except ValueError:
+            print("Movie store names are corrupt, starting without names")
+            return dict()
+        return {name: digest for name, digest in names.items() if os.path.exists(self.path(digest))}
+
+    def _save_names(self):
+        data = json.dumps(self._names, indent=1, sort_keys=True).encode('utf-8')
+        movie_format.write_atomic(os.path.join(self.root, NAMES_FILE), data)
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest + '.movie')
+
+    def resolve(self, ref: str) -> str:
+        """The digest of a stored movie referenced by digest or name, or None."""
+        with self._lock:
+            digest = self._names.get(ref, ref)
+        if DIGEST_PATTERN.match(digest) and os.path.exists(self.path(digest)):
+            return digest
+        return None
+
+    def put(self, movie: Movie, name: str = None) -> str:
+        """Stores the movie (once per content) and optionally names it, returns its digest."""
+        if name is not None and not NAME_PATTERN.match(name):
+            raise ValueError("Movie names may only contain letters, digits, '_', '.' and '-' (at most 64)")
+
+        digest = movie.digest()
+        with self._lock:
+            if not os.path.exists(self.path(digest)):
+                movie_format.write_atomic(self.path(digest), movie.save_to_binary())
+            if name is not None and self._names.get(name) != digest:
+                self._names[name] = digest
+                self._save_names()
+        return digest
+
+    def load(self, ref: str, graphics=None) -> Movie:
+        """Maps a stored movie, see lazy_movie.map_movie. None if there is no such movie."""
+        digest = self.resolve(ref)
+        if digest is None:
+            return None
+        movie = map_movie(self.path(digest), graphics)
+        movie._digest = digest  # known from the file name, no need to decode all frames for it
+        return movie
+
+    def delete(self, ref: str) -> bool:
+        """Removes a movie and all of its names. Movies which are still shown stay mapped until replaced."""
+        digest = self.resolve(ref)
+        if digest is None:
+            return False
+        with self._lock:
+            names = [name for name, named in self._names.items() if named == digest]
+            for name in names:
+                del self._names[name]
+            if names:
+                self._save_names()
+            try:
+                os.remove(self.path(digest))
+            except FileNotFoundError:
+                pass
+        return True
+
+    def entries(self) -> list:
+        with self._lock:
+            names = dict()
+            for name, digest in self._names.items():
+                names.setdefault(digest, list()).append(name)
+
+        entries = list()
+        for file_name in sorted(os.listdir(self.root)):
+            digest, extension = os.path.splitext(file_name)
+            if extension != '.movie' or not DIGEST_PATTERN.match(digest):
+                continue
+            try:
+                with open(self.path(digest), 'rb') as f:
+                    header = f.read(movie_format.HEADER.size)
+                size = os.path.getsize(self.path(digest))
+            except OSError:
+                continue  # deleted in the meantime
+            if len(header) < movie_format.HEADER.size or not movie_format.is_binary_movie(header):
+                continue
+            _, _, width, height, frame_count, fps, _, _, _ = movie_format.HEADER.unpack(header)
+            entries.append({
+                'hash': digest,
+                'names': sorted(names.get(digest, list())),
+                'frames': frame_count,
+                'fps': fps,
+                'width': width,
+                'height': height,
+                'bytes': size,
+            })
+        return entries
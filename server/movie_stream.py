@@ -0,0 +1,340 @@
+import binascii
+import codecs
+import json
+
+import animation
+from graphics_mock import Movie, MovieTooLarge, dedupe_frames, frame_digest, timing_from_wire
+from movie_format import MovieReader
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = ' \t\r\n'
+
+
+class MovieLimits:
+    def __init__(self, max_frames: int = 2000, max_bytes: int = 64 * 1024 * 1024, max_pixels: int = 256 * 256):
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes  # size of the whole request body
+        self.max_pixels = max_pixels  # width * height of a single frame
+
+
+class _JsonStreamReader:
+    """
+    Minimal pull parser over a byte stream. Only the currently parsed token is kept in memory,
+    everything before it is dropped from the buffer.
+    """
+
+    def __init__(self, stream, max_bytes: int):
+        self.stream = stream
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read_chunk(self):
+        """The next decoded chunk of the stream, None after its end."""
+        if self.eof:
+            return None
+
+        chunk = self.stream.read(CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return self.decoder.decode(b'', final=True)
+
+        self.bytes_read += len(chunk)
+        if self.bytes_read > self.max_bytes:
+            raise MovieTooLarge(f"Movie exceeds {self.max_bytes} bytes")
+        return self.decoder.decode(chunk)
+
+    def _fill(self) -> bool:
+        """Appends the next chunk to the rest of the buffer, which is small between tokens."""
+        text = self._read_chunk()
+        if text is None:
+            return False
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        return not self.eof
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of movie data")
+
+    def expect(self, c: str):
+        if self.peek() != c:
+            raise ValueError(f"Expected '{c}' at byte {self.bytes_read}, got '{self.buffer[self.pos]}'")
+        self.pos += 1
+
+    def read_string(self) -> str:
+        """Long strings (frames) are collected chunk by chunk and joined once."""
+        self.expect('"')
+        parts = list()
+        trailing = 0  # backslashes at the end of the parts, they may escape a quote at the start of the next chunk
+        scan = self.pos
+        while True:
+            end = self.buffer.find('"', scan)
+            if end < 0:
+                part = self.buffer[self.pos:]
+                backslashes = len(part) - len(part.rstrip('\\'))
+                trailing = trailing + backslashes if backslashes == len(part) else backslashes
+                parts.append(part)
+                text = self._read_chunk()
+                if text is None:
+                    raise ValueError("Unterminated string in movie data")
+                self.buffer, self.pos, scan = text, 0, 0
+                continue
+
+            # Count the backslashes in front of the quote, an odd number escapes it
+            backslashes = 0
+            while end - 1 - backslashes >= self.pos and self.buffer[end - 1 - backslashes] == '\\':
+                backslashes += 1
+            if end - backslashes == self.pos:
+                backslashes += trailing
+            if backslashes % 2 == 0:
+                break
+            scan = end + 1
+
+        parts.append(self.buffer[self.pos:end])
+        raw = ''.join(parts)
+        self.pos = end + 1
+        return json.loads('"' + raw + '"') if '\\' in raw else raw
+
+    def read_value(self):
+        """
+        Reads an arbitrary JSON value. When it is incomplete, at least as much data again is read before the next
+        attempt, so a large value is decoded a logarithmic number of times.
+        """
+        self.peek()
+        decoder = json.JSONDecoder()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+                # A number at the end of the buffer might continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise ValueError(f"Invalid value in movie data at byte {self.bytes_read}")
+
+            parts = [self.buffer[self.pos:]]
+            size = len(parts[0])
+            while size < max(2 * len(parts[0]), 1) and not self.eof:
+                text = self._read_chunk()
+                parts.append(text)
+                size += len(text)
+            self.buffer, self.pos = ''.join(parts), 0
+
+
+def _parse_movie(stream, limits: MovieLimits, on_frame) -> (dict, int):
+    """
+    Parses a movie JSON document ({"fps": ..., "frames": ["<base64 png>", ...], "durations": [ms, ...]}) from
+    a byte stream.
+    on_frame is called with every base64 frame as soon as it is complete, all other keys are returned
+    together with the number of bytes read.
+    """
+    reader = _JsonStreamReader(stream, limits.max_bytes)
+
+    data = dict()
+    frame_count = 0
+
+    reader.expect('{')
+    if reader.peek() == '}':
+        raise ValueError("Movie data has no frames")
+
+    while True:
+        key = reader.read_string()
+        reader.expect(':')
+        if key == 'frames':
+            reader.expect('[')
+            while reader.peek() != ']':
+                if frame_count >= limits.max_frames:
+                    raise MovieTooLarge(f"Movie exceeds {limits.max_frames} frames")
+
+                on_frame(reader.read_string())
+                frame_count += 1
+
+                if reader.peek() == ',':
+                    reader.expect(',')
+            reader.expect(']')
+        else:
+            data[key] = reader.read_value()
+
+        if reader.peek() == ',':
+            reader.expect(',')
+            continue
+        reader.expect('}')
+        break
+
+    return data, reader.bytes_read
+
+
+class _FrameCollector:
+    """Collects decoded frames, duplicates share the first frame with that content and its canvas."""
+
+    def __init__(self, graphics=None):
+        self.graphics = graphics
+        self.frames = list()
+        self.canvass = list() if graphics is not None else None
+        self._seen = dict()  # frame digest -> index of the first frame
+
+    def add(self, image):
+        first = self._seen.setdefault(frame_digest(image), len(self.frames))
+        if first != len(self.frames):
+            self.frames.append(self.frames[first])
+            if self.canvass is not None:
+                self.canvass.append(self.canvass[first])
+            return
+
+        self.frames.append(image)
+        if self.canvass is not None:
+            self.canvass.extend(self.graphics.convert_to_canvas([image]))
+
+    def movie(self, fps: int, durations: list = None) -> Movie:
+        movie = Movie(fps, self.frames, durations)
+        movie.canvass = self.canvass
+        return movie
+
+
+def load_movie_from_stream(stream, graphics=None, limits: MovieLimits = None) -> Movie:
+    """
+    Parses a movie JSON document from a byte stream. Every frame is decoded as soon as it is complete, and
+    converted to a canvas right away if graphics is given. The base64 and PNG data of a frame is released
+    before the next one is read.
+    """
+    limits = limits or MovieLimits()
+    collector = _FrameCollector(graphics)
+    data, _ = _parse_movie(stream, limits,
+                           lambda b64_image: collector.add(Movie.decode_frame(b64_image, limits.max_pixels)))
+    return collector.movie(*timing_from_wire(data, len(collector.frames)))
+
+
+class EncodedMovie:
+    """
+    A movie whose frames are not decoded yet, either a list of PNGs, a binary movie or an animated image.
+    Decoding can be spread over an executor for PNGs, PIL releases the GIL while decoding.
+    """
+
+    def __init__(self, fps: int, size: int, pngs: list = None, reader: MovieReader = None, durations: list = None,
+                 animation: bytes = None, frame_count: int = None, panel_size: tuple = None):
+        self.fps = fps
+        self.durations = durations
+        self.size = size  # bytes as uploaded
+        self.pngs = pngs
+        self.reader = reader
+        self.animation = animation  # fps and durations are only known after decoding
+        self.frame_count = frame_count
+        self.panel_size = panel_size  # animation frames are fit into it
+
+    def __len__(self):
+        if self.animation is not None:
+            return self.frame_count
+        return len(self.reader) if self.reader is not None else len(self.pngs)
+
+    def decode(self, executor=None, max_pixels: int = None) -> Movie:
+        """Identical PNGs are decoded only once, frames with identical content share one image."""
+        if self.animation is not None:
+            return Movie.load_from_animation(self.animation, max_pixels, self.panel_size)
+
+        if self.reader is not None:
+            # Delta frames build on the previous frame, so binary movies are decoded in order
+            frames = list()
+            for i in range(len(self.reader)):
+                duplicate_of = self.reader.duplicate_of(i)
+                frames.append(frames[duplicate_of] if duplicate_of is not None else self.reader.frame(i))
+            return Movie(self.fps, dedupe_frames(frames), self.durations)
+
+        unique = dict()
+        positions = [unique.setdefault(png, len(unique)) for png in self.pngs]
+        decode = lambda png: Movie.decode_png(png, max_pixels)
+        if executor is not None:
+            decoded = list(executor.map(decode, unique))
+        else:
+            decoded = [decode(png) for png in unique]
+        return Movie(self.fps, dedupe_frames([decoded[position] for position in positions]), self.durations)
+
+
+def read_encoded_movie_from_stream(stream, limits: MovieLimits = None) -> EncodedMovie:
+    """Parses a movie JSON document, but keeps the frames as (much smaller) PNGs for decoding them later."""
+    limits = limits or MovieLimits()
+    pngs = list()
+    data, size = _parse_movie(stream, limits, lambda b64_image: pngs.append(binascii.a2b_base64(b64_image)))
+    fps, durations = timing_from_wire(data, len(pngs))
+    return EncodedMovie(fps, size, pngs=pngs, durations=durations)
+
+
+def read_encoded_movie_from_dict(data, limits: MovieLimits = None) -> EncodedMovie:
+    """Like read_encoded_movie_from_stream, for a movie within a larger JSON document (e.g. a playlist)."""
+    limits = limits or MovieLimits()
+    if not isinstance(data, dict) or not isinstance(data.get('frames', []), list):
+        raise ValueError("Movie has to be an object with a list of frames")
+    frames = data.get('frames', [])
+    if len(frames) > limits.max_frames:
+        raise MovieTooLarge(f"Movie exceeds {limits.max_frames} frames")
+    pngs = [binascii.a2b_base64(str(b64_image)) for b64_image in frames]
+    fps, durations = timing_from_wire(data, len(pngs))
+    return EncodedMovie(fps, sum(len(png) for png in pngs), pngs=pngs, durations=durations)
+
+
+def _read_limited(stream, limits: MovieLimits) -> bytes:
+    data = stream.read(limits.max_bytes + 1)
+    if len(data) > limits.max_bytes:
+        raise MovieTooLarge(f"Movie exceeds {limits.max_bytes} bytes")
+    return data
+
+
+def read_encoded_movie_from_binary_stream(stream, limits: MovieLimits = None) -> EncodedMovie:
+    """Reads a binary movie (see movie_format) from a byte stream, the limits are checked before decoding."""
+    limits = limits or MovieLimits()
+    data = _read_limited(stream, limits)
+
+    reader = MovieReader(data)
+    if len(reader) > limits.max_frames:
+        raise MovieTooLarge(f"Movie exceeds {limits.max_frames} frames")
+    if reader.width * reader.height > limits.max_pixels:
+        raise MovieTooLarge(f"Frame of {reader.width}x{reader.height} exceeds {limits.max_pixels} pixels")
+
+    return EncodedMovie(reader.fps, len(data), reader=reader, durations=reader.durations)
+
+
+def load_movie_from_binary_stream(stream, graphics=None, limits: MovieLimits = None) -> Movie:
+    """Reads a binary movie (see movie_format) from a byte stream, the limits are checked before decoding."""
+    reader = read_encoded_movie_from_binary_stream(stream, limits).reader
+
+    collector = _FrameCollector(graphics)
+    for i in range(len(reader)):
+        collector.add(reader.frame(i))
+    return collector.movie(reader.fps, reader.durations)
+
+
+def read_encoded_animation_from_stream(stream, limits: MovieLimits = None, panel_size: tuple = None) -> EncodedMovie:
+    """
+    Reads an animated GIF, PNG or WebP from a byte stream, the limits are checked before decoding.
+    The frames are fit into panel_size when decoded.
+    """
+    limits = limits or MovieLimits()
+    data = _read_limited(stream, limits)
+
+    pil_image = animation.open_animation(data)
+    frame_count = getattr(pil_image, 'n_frames', 1)
+    if frame_count > limits.max_frames:
+        raise MovieTooLarge(f"Movie exceeds {limits.max_frames} frames")
+    if pil_image.width * pil_image.height > limits.max_pixels:
+        raise MovieTooLarge(f"Frame of {pil_image.width}x{pil_image.height} exceeds {limits.max_pixels} pixels")
+
+    return EncodedMovie(None, len(data), animation=data, frame_count=frame_count, panel_size=panel_size)
+
+
+def load_movie_from_animation_stream(stream, graphics=None, limits: MovieLimits = None) -> Movie:
+    """Reads an animated GIF, PNG or WebP from a byte stream, fit into the panel of graphics if given."""
+    limits = limits or MovieLimits()
+    encoded = read_encoded_animation_from_stream(stream, limits, graphics.size if graphics is not None else None)
+    movie = encoded.decode(max_pixels=limits.max_pixels)
+    if graphics is not None:
+        movie.canvass = graphics.convert_to_canvas(movie.frame_arrays())
+    return movie
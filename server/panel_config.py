@@ -0,0 +1,156 @@
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# How frames of another size are mapped onto the panel
+FIT_SCALE = 'scale'          # stretched to the panel, the aspect ratio changes
+FIT_CROP = 'crop'            # scaled to cover the panel, the overhang is cut off centered
+FIT_LETTERBOX = 'letterbox'  # scaled to fit into the panel, centered on black
+FITS = (FIT_SCALE, FIT_CROP, FIT_LETTERBOX)
+
+ROTATIONS = (0, 90, 180, 270)
+
+REMAP_TABLES = 8  # remap tables kept per panel, the least recently used source size is dropped first
+
+
+class PanelConfig:
+    """
+    Geometry and wiring of the panels of one cabinet, loaded from a JSON file with the fields of __init__.
+    The rgbmatrix options are derived from it, and frames of any size are mapped to the panel with remap tables,
+    which are cached for the most recently used source sizes.
+    """
+
+    def __init__(self, rows: int = 32, cols: int = 64, chain_length: int = 2, parallel: int = 1,
+                 pixel_mapper: str = 'U-mapper', hardware_mapping: str = 'adafruit-hat', gpio_slowdown: int = 4,
+                 rotation: int = 0, fit: str = FIT_LETTERBOX):
+        for name, value in (('rows', rows), ('cols', cols), ('chain_length', chain_length), ('parallel', parallel)):
+            if not isinstance(value, int) or value < 1:
+                raise ValueError(f"Panel {name} has to be a positive integer")
+        if pixel_mapper not in ('', 'U-mapper'):
+            raise ValueError(f"Unsupported pixel mapper {pixel_mapper}, expected '' or 'U-mapper'")
+        if pixel_mapper == 'U-mapper' and cols * chain_length % 2 != 0:
+            raise ValueError("The U-mapper folds the chain in half, it needs an even number of columns in total")
+        if rotation not in ROTATIONS:
+            raise ValueError(f"Panel rotation has to be one of {ROTATIONS}")
+        if fit not in FITS:
+            raise ValueError(f"Unknown fit {fit}, expected one of {FITS}")
+
+        self.rows = rows
+        self.cols = cols
+        self.chain_length = chain_length
+        self.parallel = parallel
+        self.pixel_mapper = pixel_mapper
+        self.hardware_mapping = hardware_mapping
+        self.gpio_slowdown = gpio_slowdown
+        self.rotation = rotation
+        self.fit = fit
+        self._remap_tables = OrderedDict()  # (width, height) of the source -> (indices, black), least recent first
+        self._remap_lock = threading.Lock()
+
+    @staticmethod
+    def from_dict(data: dict):
+        return PanelConfig(**data)
+
+    @staticmethod
+    def load(file_name: str):
+        with open(file_name, 'r') as f:
+            try:
+                return PanelConfig.from_dict(json.load(f))
+            except TypeError as e:
+                raise ValueError(f"Invalid panel config {file_name}: {e}")
+
+    def to_dict(self) -> dict:
+        return {
+            'rows': self.rows,
+            'cols': self.cols,
+            'chain_length': self.chain_length,
+            'parallel': self.parallel,
+            'pixel_mapper': self.pixel_mapper,
+            'hardware_mapping': self.hardware_mapping,
+            'gpio_slowdown': self.gpio_slowdown,
+            'rotation': self.rotation,
+            'fit': self.fit,
+        }
+
+    def key(self) -> tuple:
+        """Everything which changes how a frame ends up on the panel, for cache keys."""
+        return tuple(sorted(self.to_dict().items()))
+
+    @property
+    def size(self) -> tuple:
+        """(width, height) of the canvas as rgbmatrix exposes it, after the pixel mapper."""
+        width = self.cols * self.chain_length
+        height = self.rows * self.parallel
+        if self.pixel_mapper == 'U-mapper':
+            # The chain is folded in half, the second half continues below the first one
+            width, height = width // 2, height * 2
+        return width, height
+
+    @property
+    def content_size(self) -> tuple:
+        """(width, height) of the frames as the viewer sees them, after the rotation."""
+        width, height = self.size
+        return (height, width) if self.rotation in (90, 270) else (width, height)
+
+    def apply(self, options):
+        """Sets the fields of an RGBMatrixOptions."""
+        options.rows = self.rows
+        options.cols = self.cols
+        options.chain_length = self.chain_length
+        options.parallel = self.parallel
+        options.pixel_mapper_config = self.pixel_mapper
+        options.hardware_mapping = self.hardware_mapping
+        options.gpio_slowdown = self.gpio_slowdown
+
+    def remap_table(self, width: int, height: int) -> tuple:
+        """
+        (indices, black) for frames of width x height: indices is the flat source pixel of every panel pixel,
+        as a (panel height, panel width) array, black marks the panel pixels outside of the frame (letterbox).
+        """
+        with self._remap_lock:
+            table = self._remap_tables.get((width, height))
+            if table is not None:
+                self._remap_tables.move_to_end((width, height))
+                return table
+
+        content_width, content_height = self.content_size
+        if self.fit == FIT_SCALE:
+            scale_x, scale_y = content_width / width, content_height / height
+        else:
+            choose = min if self.fit == FIT_LETTERBOX else max
+            scale_x = scale_y = choose(content_width / width, content_height / height)
+
+        # Nearest neighbour, sampled at the pixel centers, the scaled frame centered on the content area
+        offset_x = (content_width - width * scale_x) / 2
+        offset_y = (content_height - height * scale_y) / 2
+        source_x = np.floor((np.arange(content_width) + 0.5 - offset_x) / scale_x).astype(np.int64)
+        source_y = np.floor((np.arange(content_height) + 0.5 - offset_y) / scale_y).astype(np.int64)
+        outside_x = (source_x < 0) | (source_x >= width)
+        outside_y = (source_y < 0) | (source_y >= height)
+
+        indices = np.clip(source_y, 0, height - 1)[:, None] * width + np.clip(source_x, 0, width - 1)[None, :]
+        black = outside_y[:, None] | outside_x[None, :]
+
+        # Rotate the content clockwise onto the panel
+        turns = -(self.rotation // 90)
+        table = (np.ascontiguousarray(np.rot90(indices, turns)), np.ascontiguousarray(np.rot90(black, turns)))
+        if not table[1].any():
+            table = (table[0], None)
+        with self._remap_lock:
+            self._remap_tables[(width, height)] = table
+            while len(self._remap_tables) > REMAP_TABLES:
+                self._remap_tables.popitem(last=False)
+        return table
+
+    def remap(self, rgb: np.ndarray) -> np.ndarray:
+        """A (height, width, 3) frame of any size mapped to the panel in one vectorized gather."""
+        height, width = rgb.shape[:2]
+        if (width, height) == self.size and self.rotation == 0:
+            return rgb
+        indices, black = self.remap_table(width, height)
+        result = np.ascontiguousarray(rgb).reshape(-1, 3)[indices]
+        if black is not None:
+            result[black] = 0
+        return result
@@ -0,0 +1,175 @@
+import datetime
+import threading
+import time
+import traceback
+
+from graphics_mock import Movie
+
+
+def parse_time_of_day(value: str) -> datetime.time:
+    try:
+        return datetime.datetime.strptime(value, '%H:%M').time()
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid time of day {value}, expected HH:MM")
+
+
+class PlaylistEntry:
+    """
+    One movie in the playlist. It is played `repeat` times in a row for `duration` seconds each (one loop of the
+    movie if not given), but only while the time of day is inside of [start, end). A window may span midnight.
+    """
+
+    def __init__(self, movie: Movie, duration: float = None, repeat: int = 1,
+                 start: datetime.time = None, end: datetime.time = None):
+        if duration is not None and duration <= 0:
+            raise ValueError("Playlist entry duration has to be positive")
+        if repeat < 1:
+            raise ValueError("Playlist entry repeat has to be at least 1")
+        if (start is None) != (end is None):
+            raise ValueError("Playlist entry needs both start and end of its time window")
+
+        self.movie = movie
+        self.duration = duration
+        self.repeat = repeat
+        self.start = start
+        self.end = end
+
+    def slot_seconds(self) -> float:
+        duration = self.duration
+        if duration is None:
+            duration = self.movie.total_seconds() or 1.0
+        return duration * self.repeat
+
+    def is_active(self, now: datetime.time) -> bool:
+        if self.start is None:
+            return True
+        if self.start <= self.end:
+            return self.start <= now < self.end
+        return now >= self.start or now < self.end
+
+    @staticmethod
+    def from_dict(data: dict, movie: Movie):
+        start = data.get('start')
+        end = data.get('end')
+        return PlaylistEntry(
+            movie,
+            duration=float(data['duration']) if data.get('duration') is not None else None,
+            repeat=int(data.get('repeat', 1)),
+            start=parse_time_of_day(start) if start is not None else None,
+            end=parse_time_of_day(end) if end is not None else None,
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            'hash': self.movie.digest(),
+            'frames': len(self.movie.frames),
+            'fps': self.movie.fps,
+            'duration': self.duration,
+            'repeat': self.repeat,
+            'start': self.start.strftime('%H:%M') if self.start is not None else None,
+            'end': self.end.strftime('%H:%M') if self.end is not None else None,
+        }
+
+
+class Playlist:
+    """
+    Rotates through the entries on its own thread. Right after an entry is published, the upcoming one is
+    decoded and converted (prepare), so the switch at the end of the slot only hands over a finished movie.
+    The render loop picks it up at its next frame boundary.
+    """
+
+    IDLE_POLL = 30.0  # seconds between checks when no entry is inside of its time window
+
+    def __init__(self, prepare, publish, settings=lambda: None, clock=time.monotonic,
+                 time_of_day=lambda: datetime.datetime.now().time()):
+        self._prepare = prepare  # Movie -> Movie with canvases, for the current graphics settings
+        self._publish = publish  # Movie -> None
+        self._settings = settings  # () -> graphics settings, a prepared movie is discarded when they changed
+        self._clock = clock
+        self._time_of_day = time_of_day
+        self._entries = list()
+        self._current = -1
+        self._prepared = None  # (entry index, entry, settings, movie)
+        self._changed = threading.Condition()
+        self._generation = 0
+
+    @property
+    def entries(self) -> list:
+        return list(self._entries)
+
+    @property
+    def current(self) -> int:
+        return self._current
+
+    def set_entries(self, entries: list):
+        with self._changed:
+            self._entries = list(entries)
+            self._current = -1
+            self._prepared = None
+            self._generation += 1
+            self._changed.notify_all()
+
+    def clear(self):
+        self.set_entries([])
+
+    def _next_active(self, after: int):
+        """Index of the next entry after `after` inside of its time window, or -1."""
+        now = self._time_of_day()
+        count = len(self._entries)
+        for offset in range(1, count + 1):
+            index = (after + offset) % count
+            if self._entries[index].is_active(now):
+                return index
+        return -1
+
+    def _take_prepared(self, index: int, entry: PlaylistEntry) -> Movie:
+        prepared = self._prepared
+        self._prepared = None
+        if prepared is not None and prepared[0] == index and prepared[1] is entry \
+                and prepared[2] == self._settings():
+            return prepared[3]
+        return self._prepare(entry.movie)
+
+    def run(self):
+        while True:
+            try:
+                self._step()
+            except Exception:
+                print("Exception: ")
+                print(traceback.format_exc())
+                time.sleep(1.0)
+
+    def _step(self):
+        with self._changed:
+            while len(self._entries) == 0:
+                self._changed.wait()
+            generation = self._generation
+            index = self._next_active(self._current)
+            if index < 0:
+                self._changed.wait(self.IDLE_POLL)
+                return
+            entry = self._entries[index]
+
+        movie = self._take_prepared(index, entry)
+        slot_end = self._clock() + entry.slot_seconds()
+        with self._changed:
+            if generation != self._generation:
+                return
+            self._current = index
+            self._publish(movie)
+            upcoming = self._next_active(index)
+            upcoming_entry = self._entries[upcoming] if upcoming >= 0 else None
+
+        if upcoming_entry is not None and upcoming != index:
+            settings = self._settings()
+            prepared = (upcoming, upcoming_entry, settings, self._prepare(upcoming_entry.movie))
+            with self._changed:
+                if generation == self._generation:
+                    self._prepared = prepared
+
+        with self._changed:
+            while generation == self._generation:
+                remaining = slot_end - self._clock()
+                if remaining <= 0:
+                    break
+                self._changed.wait(remaining)
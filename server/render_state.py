@@ -0,0 +1,103 @@
+import itertools
+import threading
+
+from graphics_mock import Movie
+
+
+class MovieSnapshot:
+    """
+    Immutable view of a movie as the render loop sees it. Changes (fps, re-converted canvases) create a new
+    snapshot with the same serial, a new movie gets a new serial. `durations` holds the seconds every frame is
+    shown at the current fps, None while paused.
+    """
+
+    __slots__ = ('movie', 'canvass', 'fps', 'serial', 'durations')
+
+    def __init__(self, movie: Movie, canvass, fps: int, serial: int):
+        # Plain lists are frozen, lazily converted canvas lists are append-only by themselves
+        object.__setattr__(self, 'movie', movie)
+        object.__setattr__(self, 'canvass', tuple(canvass) if isinstance(canvass, list) else canvass)
+        object.__setattr__(self, 'fps', fps)
+        object.__setattr__(self, 'serial', serial)
+        object.__setattr__(self, 'durations', movie.frame_seconds(fps))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("MovieSnapshot is immutable")
+
+    def with_canvass(self, canvass):
+        return MovieSnapshot(self.movie, canvass, self.fps, self.serial)
+
+    def with_fps(self, fps: int):
+        return MovieSnapshot(self.movie, self.canvass, fps, self.serial)
+
+
+class RenderState:
+    """
+    Hands movies from the request threads to the render loop. There is one pending slot (the newest movie wins)
+    and the current snapshot, both are only replaced as a whole under the lock, never modified.
+    Every change sets the `changed` event, which the render loop blocks on while there is nothing to do.
+    """
+
+    def __init__(self):
+        self.changed = threading.Event()
+        self._lock = threading.Lock()
+        self._serials = itertools.count(1)
+        self._current = None
+        self._pending = None
+
+    @property
+    def current(self) -> MovieSnapshot:
+        return self._current
+
+    @property
+    def pending(self) -> MovieSnapshot:
+        return self._pending
+
+    def latest(self) -> MovieSnapshot:
+        with self._lock:
+            return self._pending or self._current
+
+    def publish(self, movie: Movie) -> MovieSnapshot:
+        if movie.canvass is None or len(movie.canvass) == 0:
+            raise ValueError("Movie has no canvases to show")
+        snapshot = MovieSnapshot(movie, movie.canvass, movie.fps, next(self._serials))
+        with self._lock:
+            self._pending = snapshot
+        self.changed.set()
+        return snapshot
+
+    def take(self) -> MovieSnapshot:
+        """Called by the render loop once per frame, promotes the pending movie to the current one."""
+        with self._lock:
+            if self._pending is not None:
+                self._current = self._pending
+                self._pending = None
+            return self._current
+
+    def clear(self):
+        with self._lock:
+            self._current = None
+            self._pending = None
+        self.changed.set()
+
+    def set_fps(self, fps: int):
+        with self._lock:
+            if self._current is not None:
+                self._current = self._current.with_fps(fps)
+            if self._pending is not None:
+                self._pending = self._pending.with_fps(fps)
+        self.changed.set()
+
+    def replace_canvass(self, snapshot: MovieSnapshot, canvass) -> bool:
+        """Swaps in re-converted canvases, if the movie of the snapshot is still current or pending."""
+        with self._lock:
+            replaced = False
+            if self._current is not None and self._current.serial == snapshot.serial:
+                self._current = self._current.with_canvass(canvass)
+                replaced = True
+            if self._pending is not None and self._pending.serial == snapshot.serial:
+                self._pending = self._pending.with_canvass(canvass)
+                replaced = True
+        if replaced:
+            self.changed.set()
+        return replaced
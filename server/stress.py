@@ -0,0 +1,163 @@
+"""
+Hammers the control API from several threads while the render loop plays movies on the mock graphics, and checks
+the display log for torn or skipped frames.
+
+    python stress.py --duration 10 --threads 4
+
+Every frame of the test movies has a color of its own, so every canvas can be traced back to its movie and frame.
+The frame policy is 'repeat', so the render loop never drops a frame on purpose. A displayed canvas which does not
+belong to a converted frame is torn, a movie has to start at its first frame and then advance one frame at a time
+(or show the same frame again, after a brightness or fps change). Exits with 1 if any check failed.
+"""
+import argparse
+import base64
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from PIL import Image
+
+from benchmark import InstrumentedGraphics
+from frame_scheduler import POLICY_REPEAT
+from graphics_mock import frame_to_array
+
+MOVIE_COUNT = 6
+FRAME_SIZE = (32, 16)
+
+
+class TracingGraphics(InstrumentedGraphics):
+    """Remembers the (movie, frame) of every converted canvas, from the color of its frame."""
+
+    def __init__(self, brightness: int, colors: dict):
+        super().__init__(brightness)
+        self.colors = colors  # (r, g, b) -> (movie, frame)
+        self.traces = dict()  # id(canvas) -> (movie, frame)
+        self._canvass = list()  # keeps the ids unique
+
+    def convert_to_canvas(self, frames: list, adjustment=None) -> list:
+        canvass = super().convert_to_canvas(frames, adjustment)
+        for frame, canvas in zip(frames, canvass):
+            self.traces[id(canvas)] = self.colors.get(tuple(int(c) for c in frame_to_array(frame)[0, 0]))
+            self._canvass.append(canvas)
+        return canvass
+
+
+def make_movies() -> tuple:
+    """(JSON bodies of the test movies, color -> (movie, frame))"""
+    bodies = list()
+    colors = dict()
+    for movie in range(MOVIE_COUNT):
+        encoded = list()
+        for frame in range(6 + movie * 2):
+            color = (movie, frame, 255)
+            colors[color] = (movie, frame)
+            with io.BytesIO() as f:
+                Image.new('RGB', FRAME_SIZE, color).save(f, format='PNG')
+                encoded.append(base64.b64encode(f.getvalue()).decode('ascii'))
+        bodies.append(json.dumps({'fps': 20, 'frames': encoded}))
+    return bodies, colors
+
+
+def hammer(app, bodies: list, stop: threading.Event, seed: int, counts: dict):
+    """Random requests until stop is set, counts the status codes."""
+    rng = random.Random(seed)
+    client = app.app.test_client()
+    hashes = list()
+    while not stop.is_set():
+        action = rng.random()
+        if action < 0.3:
+            response = client.post('/rest/v1/image?wait=30', data=rng.choice(bodies))
+            if response.status_code == 200:
+                hashes.append(response.get_json()['result']['hash'])
+        elif action < 0.4 and hashes:
+            response = client.post(f'/rest/v1/image/{rng.choice(hashes)}')
+        elif action < 0.6:
+            response = client.post('/rest/v1/fps', data=str(rng.randint(5, 40)))
+        elif action < 0.8:
+            response = client.post('/rest/v1/brightness', data=str(rng.randint(10, 100)))
+        elif action < 0.82:
+            response = client.get('/rest/v1/clear')
+        else:
+            response = client.get('/rest/v1/debug')
+        counts[response.status_code] = counts.get(response.status_code, 0) + 1
+        time.sleep(rng.random() * 0.01)
+
+
+def check_display_log(graphics: TracingGraphics, frame_counts: list) -> dict:
+    """Walks the display log, every displayed canvas has to be the same or the next frame of its movie."""
+    torn = list()
+    skipped = list()
+    previous = None
+    with graphics._displayed_changed:
+        displayed = list(graphics.displayed)
+    for i, (displayed_at, canvas) in enumerate(displayed):
+        trace = graphics.traces.get(id(canvas))
+        if trace is None:
+            torn.append({'display': i, 'error': "Canvas of no converted frame"})
+            previous = None
+            continue
+
+        movie, frame = trace
+        if frame == 0 or previous is not None and previous[0] == movie and \
+                frame in (previous[1], (previous[1] + 1) % frame_counts[movie]):
+            pass  # a new movie starts, or the same movie goes on
+        elif previous is not None and previous[0] == movie:
+            skipped.append({'display': i, 'movie': movie, 'from': previous[1], 'to': frame})
+        else:
+            torn.append({'display': i, 'error': f"Movie {movie} starts at frame {frame}", 'previous': previous})
+        previous = trace
+    return {'displays': len(displayed), 'torn': torn, 'skipped': skipped}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=10.0, help="Seconds to hammer the API")
+    parser.add_argument('--threads', type=int, default=4, help="Concurrent clients")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    os.environ['MATRIX_GRAPHICS'] = 'mock'
+    os.chdir(tempfile.mkdtemp(prefix='matrix-stress-'))
+    bodies, colors = make_movies()
+    frame_counts = [len(json.loads(body)['frames']) for body in bodies]
+
+    # The server logs to stdout, keep it clean for the results
+    with contextlib.redirect_stdout(sys.stderr):
+        import app  # starts the render loop
+        graphics = TracingGraphics(app.BRIGHTNESS, colors)
+        app.GLOBAL_GRAPHICS = graphics
+        app.FRAME_SCHEDULER.policy = POLICY_REPEAT
+
+        stop = threading.Event()
+        counts = dict()
+        threads = [threading.Thread(target=hammer, args=(app, bodies, stop, args.seed + i, counts), daemon=True)
+                   for i in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        time.sleep(0.5)  # the last movie is displayed
+
+        results = check_display_log(graphics, frame_counts)
+        results['responses'] = {str(status): count for status, count in sorted(counts.items())}
+
+    print(json.dumps(results, indent=2))
+    errors = [status for status in counts if status >= 500]
+    if results['torn'] or results['skipped'] or errors:
+        print(f"FAILED: {len(results['torn'])} torn, {len(results['skipped'])} skipped frames, "
+              f"{sum(counts[status] for status in errors)} server errors", file=sys.stderr)
+        return 1
+    print(f"OK: {results['displays']} frames displayed", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())